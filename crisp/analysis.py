@@ -1,4 +1,3 @@
-import cbor
 from functools import wraps
 import inspect
 import json
@@ -1,3 +1,4 @@
+import functools
 from .abc import LLMFileFormat
 from . import markdown
 from . import xml
@@ -8,6 +9,18 @@ _FILE_FORMATTER_CLASSES_BY_NAME = {
 }
 
 def get_file_formatter(name: str, **kwargs) -> LLMFileFormat:
+    if not kwargs:
+        # Share one instance per format, so its emit cache carries over from
+        # one prompt to the next.  The instance lives until the process exits,
+        # holding up to `LLMFileFormat.EMIT_CACHE_LIMIT` of cached output.
+        return _default_file_formatter(name)
+    return _new_file_formatter(name, **kwargs)
+
+@functools.cache
+def _default_file_formatter(name: str) -> LLMFileFormat:
+    return _new_file_formatter(name)
+
+def _new_file_formatter(name: str, **kwargs) -> LLMFileFormat:
     cls = _FILE_FORMATTER_CLASSES_BY_NAME.get(name)
     if cls is None:
         raise ValueError(f'unknown file formatter {name!r}')
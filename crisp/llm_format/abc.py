@@ -1,10 +1,123 @@
 from abc import ABCMeta, abstractmethod
-import os
+from collections import OrderedDict
+import fnmatch
 import pathlib
+import re
+from typing import Callable, Collection, Iterator
 
-from ..mvir import MVIR, FileNode, TreeNode
+from ..mvir import MVIR, FileNode, NodeId, TreeNode
+
+def _iter_lines(s: str) -> Iterator[tuple[str, int, int]]:
+    '''
+    Yields `(line, start, next_start)` for each line of `s`, where `start` is
+    the offset of the line within `s` and `next_start` is the offset of the
+    following line.  The yielded `line` doesn't include the trailing `\n` or
+    `\r\n`.  Unlike `s.splitlines()`, this splits only on `\n`, which lets
+    callers slice multi-line spans out of `s` directly instead of re-joining
+    lines; use `_block_body` to normalize such a span.
+    '''
+    pos = 0
+    n = len(s)
+    while pos < n:
+        end = s.find('\n', pos)
+        if end < 0:
+            end = n
+        line_end = end
+        if line_end > pos and s[line_end - 1] == '\r':
+            line_end -= 1
+        yield s[pos:line_end], pos, min(end + 1, n)
+        pos = end + 1
+
+def _block_body(s: str, start: int, end: int) -> str:
+    '''
+    Returns the text of the lines of `s` between offsets `start` and `end`,
+    which must be line boundaries, in the same form as
+    `'\n'.join(lines) + '\n'`: `\r\n` line breaks are normalized to `\n`,
+    and an empty span gives `'\n'`.  Other characters, such as form feeds,
+    are kept as they are.
+    '''
+    return s[start:end].replace('\r\n', '\n') or '\n'
+
+def _glob_matcher(pattern: str) -> Callable[[str], bool]:
+    '''
+    Build a function that checks whether a path matches the glob `pattern`,
+    following the same rules as `pathlib.PurePath.match`: each `/`-separated
+    component is matched separately, so `*` never matches across a `/`, and
+    relative patterns are matched against the end of the path.  The pattern is
+    compiled once up front, instead of on every `PurePath(path).match(pattern)`
+    call.
+    '''
+    parts = pathlib.PurePosixPath(pattern).parts
+    absolute = parts[:1] == ('/',)
+    if absolute:
+        parts = parts[1:]
+    regexes = tuple(re.compile(fnmatch.translate(part)) for part in parts)
+    n = len(regexes)
+
+    def match(path: str) -> bool:
+        path_parts = path.split('/')
+        if path.startswith('/'):
+            del path_parts[0]
+        elif absolute:
+            return False
+        if len(path_parts) < n or (absolute and len(path_parts) != n):
+            return False
+        return all(r.match(p) for r, p in zip(regexes, path_parts[-n:]))
+
+    return match
+
+def _is_plausible_path(path: str) -> bool:
+    '''
+    Heuristics for rejecting text that appears where an LLM should have written
+    a file path, but doesn't look like a normalized relative path.
+    '''
+    # Whitespace.  `isprintable` is false for every whitespace character
+    # except the plain space, so this catches the same paths as checking for
+    # `len(path.split()) > 1`, without building a list.
+    if ' ' in path or not path.isprintable():
+        return False
+    if '..' in path:
+        return False
+    # Reject paths that `os.path.normpath` would change: empty paths, empty
+    # components, `.` components, and trailing slashes.  With `..` already
+    # excluded, these substring checks cover the same cases without building
+    # a normalized copy of the path.
+    if (path == '' or path == '.' or '//' in path or path.endswith('/')
+            or path.startswith('./') or path.endswith('/.') or '/./' in path):
+        return False
+    return True
+
+def _common_dir(paths: Collection[str]) -> str:
+    '''
+    Returns the longest common directory of the normalized relative `paths`,
+    like `os.path.commonpath`, or the parent directory if there is only one
+    path.  Instead of splitting every path into components, this compares
+    only the lexicographically smallest and largest paths, whose common string
+    prefix is shared by all the others, and then trims it back to the last
+    `/`.
+    '''
+    if len(paths) == 0:
+        return ''
+    lo = min(paths)
+    hi = max(paths)
+    n = min(len(lo), len(hi))
+    i = 0
+    while i < n and lo[i] == hi[i]:
+        i += 1
+    # For a single path, `lo` and `hi` are the same, so this gives its
+    # directory.
+    return lo[:max(lo.rfind('/', 0, i), 0)]
 
 class LLMFileFormat(metaclass = ABCMeta):
+    # Maximum total size of the outputs kept by `_emit_file_cached`.  The
+    # shared instances from `get_file_formatter` live for the whole process,
+    # so this is kept to a few prompts' worth of text.
+    EMIT_CACHE_LIMIT = 4 * 1024 * 1024
+
+    def __init__(self):
+        self._emit_cache = OrderedDict()
+        self._emit_cache_size = 0
+
     @abstractmethod
     def get_output_instructions(self) -> str:
         '''
@@ -34,52 +147,176 @@ class LLMFileFormat(metaclass = ABCMeta):
             s = s[0].lower() + s[1:]
         return s
 
+    def file_type(self, path: str) -> str | None:
+        '''
+        Returns the file type label to use when emitting `path`, or `None` if
+        this format can't represent `path`, in which case `emit_files` skips
+        it.  Formats that don't label files with a type return `''`.
+        '''
+        return ''
+
     @abstractmethod
-    def emit_file(self, n: FileNode, path: str) -> str:
+    def iter_file(
+        self,
+        n: FileNode,
+        path: str,
+        file_type: str | None = None,
+    ) -> Iterator[str]:
+        '''
+        Yields successive chunks of formatted text giving the contents of file
+        `n`.  `file_type`, if provided, is the result of `self.file_type(path)`;
+        callers that already have it can pass it in to avoid recomputing it.
+        '''
         ...
 
-    def emit_files(
+    def iter_file_bytes(
+        self,
+        n: FileNode,
+        path: str,
+        file_type: str | None = None,
+    ) -> Iterator[bytes]:
+        '''
+        Like `iter_file`, but yields UTF-8 encoded chunks.  The default
+        implementation encodes the output of `iter_file`; formats override this
+        to yield the raw file body directly, skipping the decode and re-encode.
+        '''
+        for chunk in self.iter_file(n, path, file_type):
+            yield chunk.encode('utf-8')
+
+    def emit_file(self, n: FileNode, path: str, file_type: str | None = None) -> str:
+        '''
+        Generate formatted text giving the contents of file `n`.
+        '''
+        return ''.join(self.iter_file(n, path, file_type))
+
+    def emit_file_bytes(self, n: FileNode, path: str, file_type: str | None = None) -> bytes:
+        '''
+        Like `emit_file`, but returns UTF-8 encoded output.
+        '''
+        return b''.join(self.iter_file_bytes(n, path, file_type))
+
+    def _emit_file_cached(
+        self,
+        mvir: MVIR,
+        node_id: NodeId,
+        path: str,
+        file_type: str | None,
+        as_bytes: bool,
+    ) -> str | bytes:
+        '''
+        Like `emit_file` or `emit_file_bytes`, but reuses the output from
+        earlier calls with the same file.  Nodes are immutable and addressed by
+        content, so the output for a given node, path, and type never changes.
+        The least recently used entries are dropped once the cached output
+        exceeds `EMIT_CACHE_LIMIT` characters (or bytes).
+        '''
+        key = (node_id, path, file_type, as_bytes)
+        cache = self._emit_cache
+        text = cache.get(key)
+        if text is not None:
+            cache.move_to_end(key)
+            return text
+
+        n = mvir.node(node_id)
+        if as_bytes:
+            text = self.emit_file_bytes(n, path, file_type)
+        else:
+            text = self.emit_file(n, path, file_type)
+        if len(text) <= self.EMIT_CACHE_LIMIT:
+            cache[key] = text
+            self._emit_cache_size += len(text)
+            while self._emit_cache_size > self.EMIT_CACHE_LIMIT:
+                _, old = cache.popitem(last=False)
+                self._emit_cache_size -= len(old)
+        return text
+
+    def iter_emit_files(
         self,
         mvir: MVIR,
         n: TreeNode,
         glob_filter: str = None,
-    ) -> tuple[str, dict[str, str]]:
+        *,
+        short_path_map: dict[str, str] | None = None,
+        as_bytes: bool = False,
+    ) -> Iterator[str] | Iterator[bytes]:
         """
-        Generate formatted text giving the contents of files in `n`, along with
-        a dict mapping short path names used in the output to full paths as
-        used in `n`.  Output is formatted like `emit_file`.  If `glob_filter`
-        is set to a string, only files whose paths match that glob pattern will
-        be included.
+        Yields successive chunks of the output of `emit_files`, so that callers
+        can stream it somewhere without holding the whole thing in memory.  If
+        `short_path_map` is provided, it is filled in with the mapping that
+        `emit_files` would return.
         """
         assert isinstance(n, TreeNode)
 
         if isinstance(glob_filter, str):
             glob_filter = (glob_filter,)
+        if glob_filter is not None:
+            glob_matchers = tuple(_glob_matcher(g) for g in glob_filter)
 
-        if len(n.files) == 0:
-            common_prefix = ''
-        elif len(n.files) == 1:
-            common_prefix = os.path.dirname(list(n.files.keys())[0])
-        else:
-            common_prefix = os.path.commonpath(n.files.keys())
+        common_prefix = _common_dir(n.files.keys())
+        # Every path starts with `common_prefix` followed by a `/` (unless the
+        # prefix is empty), so the short path is just the remainder.
+        prefix_len = len(common_prefix) + 1 if common_prefix else 0
 
-        parts = []
-        short_path_map = {}
+        sep = b'\n\n' if as_bytes else '\n\n'
+        if short_path_map is None:
+            short_path_map = {}
+        first = True
         for path, child_id in n.files.items():
             if glob_filter is not None:
-                path_obj = pathlib.Path(path)
-                glob_match = any(path_obj.match(g) for g in glob_filter)
-                if not glob_match:
+                if not any(m(path) for m in glob_matchers):
                     continue
 
-            short_path = os.path.relpath(path, common_prefix)
+            assert path.startswith(common_prefix)
+            short_path = path[prefix_len:]
+            file_type = self.file_type(short_path)
+            if file_type is None:
+                continue
             assert short_path not in short_path_map
             short_path_map[short_path] = path
 
-            child_node = mvir.node(child_id)
-            part = self.emit_file(child_node, short_path)
-            parts.append(part)
-        return '\n\n'.join(parts), short_path_map
+            if not first:
+                yield sep
+            first = False
+            yield self._emit_file_cached(mvir, child_id, short_path, file_type, as_bytes)
+
+    def emit_files(
+        self,
+        mvir: MVIR,
+        n: TreeNode,
+        glob_filter: str = None,
+        *,
+        as_bytes: bool = False,
+    ) -> tuple[str | bytes, dict[str, str]]:
+        """
+        Generate formatted text giving the contents of files in `n`, along with
+        a dict mapping short path names used in the output to full paths as
+        used in `n`.  Output is formatted like `emit_file`.  If `glob_filter`
+        is set to a string, only files whose paths match that glob pattern will
+        be included.  Files that the format can't represent (see `file_type`)
+        are omitted.  If `as_bytes` is set, the output is UTF-8 encoded `bytes`
+        instead of a `str`.
+        """
+        files = n.files
+        if len(files) == 0:
+            return (b'' if as_bytes else ''), {}
+        if len(files) == 1 and glob_filter is None:
+            # A lone file's common directory is its parent, so its short path
+            # is just the file name.
+            (path, child_id), = files.items()
+            short_path = path[path.rfind('/') + 1:]
+            file_type = self.file_type(short_path)
+            if file_type is None:
+                return (b'' if as_bytes else ''), {}
+            text = self._emit_file_cached(mvir, child_id, short_path, file_type, as_bytes)
+            return text, {short_path: path}
+
+        short_path_map = {}
+        # The chunks are joined with a single allocation at the end, without
+        # building a separate string for each file first.
+        chunks = self.iter_emit_files(mvir, n, glob_filter,
+            short_path_map=short_path_map, as_bytes=as_bytes)
+        text = (b'' if as_bytes else '').join(chunks)
+        return text, short_path_map
 
     @abstractmethod
     def extract_files(self, s: str) -> list[tuple[str, str]]:
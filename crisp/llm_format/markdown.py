@@ -1,6 +1,6 @@
-import os
+from typing import Iterator
 from ..mvir import MVIR, FileNode, TreeNode
-from .abc import LLMFileFormat
+from .abc import LLMFileFormat, _block_body, _is_plausible_path, _iter_lines
 
 DEFAULT_FILE_TYPE_MAP = {
     '.rs': 'Rust',
@@ -8,15 +8,98 @@ DEFAULT_FILE_TYPE_MAP = {
     '.h': 'C',
 }
 
+def _file_type(path: str, file_type_map: dict[str, str]) -> str | None:
+    dot = path.rfind('.')
+    if dot <= path.rfind('/'):
+        # No extension
+        return None
+    return file_type_map.get(path[dot:])
+
+def _is_block_header(path: str, lang: str, lower_file_type_map: dict[str, str]) -> bool:
+    """
+    Check whether `path` followed by an opening fence for the lowercased
+    language `lang` looks like the start of a code block produced by
+    `MarkdownFileFormat.emit_file`.
+    """
+    if not _is_plausible_path(path):
+        return False
+    return _file_type(path, lower_file_type_map) == lang
+
+def _extract_markdown(
+    s: str,
+    lower_file_type_map: dict[str, str],
+    fence_to_lang: dict[str, str],
+) -> list[tuple[str, str]]:
+    """
+    Extract from `s` all markdown code blocks that appear to match the format
+    of `MarkdownFileFormat.emit_file`.  `lower_file_type_map` is the format's
+    file type map with the types lowercased, and `fence_to_lang` maps each
+    lowercased opening fence line (like "```rust") to its language.  It may
+    also contain other spellings of the same fences (like "```Rust"), which
+    are tried before lowercasing the line.  Blocks in any other language are
+    rejected without looking at the preceding line.
+    """
+    files = []
+
+    # `body_start` is the offset of the first line inside a markdown code
+    # block, or `None` if we aren't currently in a block.
+    body_start = None
+    path = None
+    prev_line = None
+    for line, start, next_start in _iter_lines(s):
+        if line == '```':
+            if body_start is not None:
+                files.append((path, _block_body(s, body_start, start)))
+            body_start = None
+        elif line.startswith('```'):
+            body_start = None
+            fence = line.strip()
+            lang = fence_to_lang.get(fence)
+            if lang is None:
+                lang = fence_to_lang.get(fence.lower())
+            # The line before the start of the block should contain the file
+            # path.
+            if (lang is not None and prev_line is not None
+                    and _is_block_header(prev_line, lang, lower_file_type_map)):
+                path = prev_line
+                body_start = next_start
+        prev_line = line
+
+    return files
+
 class MarkdownFileFormat(LLMFileFormat):
     def __init__(self, file_type_map: dict[str, str] = DEFAULT_FILE_TYPE_MAP):
+        super().__init__()
         self.file_type_map = file_type_map
+        # Case-insensitive lookup tables for `extract_files`, built once here
+        # so that parsing doesn't need to lowercase every file type.
+        self._lower_file_type_map = {ext: t.lower() for ext, t in file_type_map.items()}
+        self._fence_to_lang = {'```' + t: t for t in self._lower_file_type_map.values()}
+        # Also accept the fences exactly as `iter_file` emits them, which is
+        # what well-behaved model output contains, without lowercasing.
+        for t in file_type_map.values():
+            self._fence_to_lang.setdefault('```' + t, t.lower())
 
     def get_output_instructions(self) -> str:
         return ('Output the updated Rust code in a Markdown code block, '
             'with the file path on the preceding line, as shown in the input.')
 
-    def emit_file(self, n: FileNode, path: str) -> str:
+    def file_type(self, path: str) -> str | None:
+        return _file_type(path, self.file_type_map)
+
+    def _require_file_type(self, path: str, file_type: str | None) -> str:
+        if file_type is None:
+            file_type = self.file_type(path)
+            if file_type is None:
+                raise ValueError(f'unsupported file type for {path!r}')
+        return file_type
+
+    def iter_file(
+        self,
+        n: FileNode,
+        path: str,
+        file_type: str | None = None,
+    ) -> Iterator[str]:
         """
         Generate markdown-formatted text giving the contents of file `n`.  Produces
         output of the form:
@@ -26,49 +109,31 @@ class MarkdownFileFormat(LLMFileFormat):
             // File contents...
             ```
         """
-        file_type = self.file_type_map[os.path.splitext(path)[1]]
-        text = n.body_str()
-        return '\n'.join((path, '```' + file_type, text, '```'))
+        file_type = self._require_file_type(path, file_type)
+        yield path
+        yield '\n```'
+        yield file_type
+        yield '\n'
+        yield n.body_str()
+        yield '\n```'
+
+    def iter_file_bytes(
+        self,
+        n: FileNode,
+        path: str,
+        file_type: str | None = None,
+    ) -> Iterator[bytes]:
+        file_type = self._require_file_type(path, file_type)
+        yield path.encode('utf-8')
+        yield b'\n```'
+        yield file_type.encode('utf-8')
+        yield b'\n'
+        yield n.body()
+        yield b'\n```'
 
     def extract_files(self, s: str) -> list[tuple[str, str]]:
         """
         Extract from `s` all markdown code blocks that appear to match the format
         of `emit_file`.
         """
-        files = []
-
-        lines = s.splitlines()
-        # `start_i` is the index of the opening line of a markdown code block
-        # ("```Rust" or similar), or `None` if we aren't currently in a block.
-        start_i = None
-        for i, line in enumerate(lines):
-            if line == '```':
-                if start_i is not None:
-                    path = lines[start_i - 1]
-                    text = '\n'.join(lines[start_i + 1 : i]) + '\n'
-                    files.append((path, text))
-                start_i = None
-            elif line.startswith('```'):
-                start_i = None
-                if i == 0:
-                    continue
-
-                # The line before the start of the block should contain the file
-                # path.
-                path = lines[i - 1]
-                # Some heuristics to reject non-path text before the block.
-                if len(path.split(None, 1)) > 1:
-                    # Invalid path (contains whitespace)
-                    continue
-                if '..' in path:
-                    continue
-                if os.path.normpath(path) != path:
-                    continue
-
-                file_type = self.file_type_map[os.path.splitext(path)[1]]
-                if line.strip().lower() != '```' + file_type.lower():
-                    continue
-
-                start_i = i
-
-        return files
+        return _extract_markdown(s, self._lower_file_type_map, self._fence_to_lang)
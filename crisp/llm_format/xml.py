@@ -1,29 +1,59 @@
-import os
+import functools
 import pathlib
 import re
+from typing import Iterator
 from ..mvir import MVIR, FileNode, TreeNode
-from .abc import LLMFileFormat
+from .abc import LLMFileFormat, _block_body, _is_plausible_path
 
-RE_OPEN_TAG = re.compile(r'^<file name="([^"]*)">$')
-# Qwen3-Coder-30B-A3B-Instruct often omits the final `>` for some reason, so we
-# accept both `</file>` and `</file` here.
-RE_CLOSE_TAG = re.compile(r'^</file>?$')
+@functools.cache
+def _tag_re() -> re.Pattern:
+    """
+    Regex matching a whole line that is either an opening `<file name="...">`
+    tag, in which case group 1 is the path, or a closing `</file>` tag.  For
+    lines ending in `\r\n`, the match includes the `\r`.  This is compiled
+    on first use, so that commands that never parse LLM output don't pay for
+    it at import time.
+    """
+    # Qwen3-Coder-30B-A3B-Instruct often omits the final `>` for some reason,
+    # so we accept both `</file>` and `</file` here.
+    return re.compile(r'^(?:<file name="([^"]*)">|</file>?)\r?$', re.MULTILINE)
 
 class XmlFileFormat(LLMFileFormat):
     def get_output_instructions(self) -> str:
         return ('Output the code for each modified file inside '
             '<file name="foo.rs">...</file>, as shown in the input.')
 
-    def emit_file(self, n: FileNode, path: str) -> str:
+    def iter_file(
+        self,
+        n: FileNode,
+        path: str,
+        file_type: str | None = None,
+    ) -> Iterator[str]:
         """
-        Generate markdown-formatted text giving the contents of file `n`.  Produces
+        Generate XML-formatted text giving the contents of file `n`.  Produces
         output of the form:
 
             <file name="/path/to/file.rs">
             // File contents...
             </file>
         """
-        return '\n'.join((f'<file name="{path}">', n.body_str(), '</file>'))
+        yield '<file name="'
+        yield path
+        yield '">\n'
+        yield n.body_str()
+        yield '\n</file>'
+
+    def iter_file_bytes(
+        self,
+        n: FileNode,
+        path: str,
+        file_type: str | None = None,
+    ) -> Iterator[bytes]:
+        yield b'<file name="'
+        yield path.encode('utf-8')
+        yield b'">\n'
+        yield n.body()
+        yield b'\n</file>'
 
     def extract_files(self, s: str) -> list[tuple[str, str]]:
         """
@@ -32,33 +62,29 @@ class XmlFileFormat(LLMFileFormat):
         """
         files = []
 
-        lines = s.splitlines()
-        # `start_i` is the index of the opening line of an XML block (similar to
-        # `<file name="foo.rs">`), or `None` if we aren't currently in a block.
-        start_i = None
+        # Find tags with a single scan over the whole string, rather than
+        # splitting it into lines and matching each line separately.
+        #
+        # `body_start` is the offset of the first line inside an XML block
+        # (similar to `<file name="foo.rs">`), or `None` if we aren't currently
+        # in a block.
+        body_start = None
         start_path = None
-        for i, line in enumerate(lines):
-            if (m := RE_OPEN_TAG.match(line)):
-                start_i, start_path = None, None
+        for m in _tag_re().finditer(s):
+            path = m.group(1)
+            if path is not None:
+                body_start, start_path = None, None
 
-                path = m.group(1)
-                # Some heuristics to reject bad paths.
-                if len(path.split(None, 1)) > 1:
-                    # Invalid path (contains whitespace)
-                    continue
-                if '..' in path:
-                    continue
-                if os.path.normpath(path) != path:
+                if not _is_plausible_path(path):
                     continue
 
-                start_i = i
+                # Skip the newline that ends the tag line.
+                body_start = m.end() + 1
                 start_path = path
 
-            elif (m := RE_CLOSE_TAG.match(line)):
-                if start_i is not None:
-                    path = start_path
-                    text = '\n'.join(lines[start_i + 1 : i]) + '\n'
-                    files.append((path, text))
-                start_i, start_path = None, None
+            else:
+                if body_start is not None:
+                    files.append((start_path, _block_body(s, body_start, m.start())))
+                body_start, start_path = None, None
 
         return files
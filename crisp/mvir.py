@@ -1,16 +1,46 @@
-from cbor import cbor
-from dataclasses import dataclass
+import cbor2 as cbor
+import collections
+import concurrent.futures
+from dataclasses import dataclass, field
 from datetime import datetime
+import errno
 import hashlib
+import io
 import json
+import operator
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import os
 import stat
+import sys
 import tempfile
 import typing
 from typing import Any, Callable, ClassVar, Optional, Annotated, TypeVar
-from types import NoneType
+from types import BuiltinFunctionType, NoneType, UnionType
 from weakref import WeakValueDictionary
 
+if not isinstance(cbor.loads, BuiltinFunctionType):
+    print('warning: cbor2 was built without its C extension; '
+        'falling back to slower pure-Python CBOR', file=sys.stderr)
+
+def _cbor_decoder(f):
+    '''Returns a function that decodes the next CBOR item from `f` each time
+    it's called, reusing a single decoder for all items.'''
+    return cbor.CBORDecoder(f).decode
+
+def _json_loads(data):
+    '''Parse JSON from UTF-8 `data`.  Uses `orjson` when it's installed,
+    falling back to the standard library for inputs `orjson` rejects, such as
+    `NaN`.'''
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data.decode('utf-8'))
+
 
 T = TypeVar("T")
 
@@ -22,17 +52,46 @@ Metadata = Annotated[T, MetadataTag]
 Mark a type as CRISP metadata.
 """
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True, weakref_slot=True)
 class NodeId:
     raw: bytes
+    # Cached result of `hex()`.  Not part of the ID's identity.
+    _hex: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    # Cached hash of `raw`.  `NodeId`s are used heavily as dict and set keys.
+    _hash: int = field(default=0, init=False, repr=False, compare=False)
 
     LENGTH: ClassVar[int] = hashlib.sha256().digest_size
 
+    # Maps raw bytes to the live `NodeId` for those bytes.  See `intern`.
+    _interned: ClassVar[WeakValueDictionary] = WeakValueDictionary()
+
     def __post_init__(self):
         assert len(self.raw) == NodeId.LENGTH
+        object.__setattr__(self, '_hash', hash(self.raw))
+
+    def __hash__(self):
+        return self._hash
+
+    @classmethod
+    def intern(cls, raw):
+        '''Get a `NodeId` for `raw`, reusing an existing instance if there is
+        one.  Used for IDs read from disk, where the same ID is often seen many
+        times.'''
+        node_id = cls._interned.get(raw)
+        if node_id is None:
+            node_id = cls(raw)
+            cls._interned[raw] = node_id
+        return node_id
+
+    def hex(self):
+        h = self._hex
+        if h is None:
+            h = self.raw.hex()
+            object.__setattr__(self, '_hex', h)
+        return h
 
     def __str__(self):
-        return self.raw.hex()
+        return self.hex()
 
     def __repr__(self):
         return 'NodeId(%s)' % self
@@ -41,109 +100,345 @@ class NodeId:
     def from_str(s):
         if len(s) != 2 * NodeId.LENGTH:
             raise ValueError('expected exactly %d characters' % (2 * NodeId.LENGTH))
-        raw = bytes(int(s[i:i+2], 16) for i in range(0, len(s), 2))
-        return NodeId(raw)
+        raw = bytes.fromhex(s)
+        if len(raw) != NodeId.LENGTH:
+            # `fromhex` skips whitespace, so `s` may have been too short.
+            raise ValueError('invalid hex digits in %r' % (s,))
+        return NodeId.intern(raw)
 
     def to_cbor(self):
         return self.raw
 
     @classmethod
     def from_cbor(cls, raw):
-        return cls(raw)
+        return cls.intern(raw)
 
     @classmethod
     def check_type(cls, x):
         assert isinstance(x, cls), 'expected %r, but got %r' % (cls, type(x))
 
 
+_PRIMITIVE_TYPES = (NoneType, bool, int, float, str, bytes)
+
+# Kinds of type annotation handled by `from_cbor` and `check_type`.
+_KIND_PRIMITIVE = 0
+_KIND_LIST = 1
+_KIND_TUPLE = 2
+_KIND_DICT = 3
+_KIND_DATETIME = 4
+_KIND_ANY = 5
+_KIND_UNION = 6
+_KIND_OTHER = 7
+
+_type_info_cache = {}
+
+def _type_info(ty):
+    '''Returns `(kind, origin, args)` for the type annotation `ty`.  This
+    gets called on every metadata value, so the results of `get_origin` and
+    `get_args` are cached per type.'''
+    info = _type_info_cache.get(ty)
+    if info is not None:
+        return info
+
+    origin = typing.get_origin(ty) or ty
+    if origin in _PRIMITIVE_TYPES:
+        kind = _KIND_PRIMITIVE
+    elif origin is list:
+        kind = _KIND_LIST
+    elif origin is tuple:
+        kind = _KIND_TUPLE
+    elif origin is dict:
+        kind = _KIND_DICT
+    elif origin is datetime:
+        kind = _KIND_DATETIME
+    elif origin is typing.Any:
+        kind = _KIND_ANY
+    elif origin is typing.Union or origin is UnionType:
+        kind = _KIND_UNION
+    else:
+        kind = _KIND_OTHER
+    info = (kind, origin, typing.get_args(ty))
+    _type_info_cache[ty] = info
+    return info
+
+_first = operator.itemgetter(0)
+
 def to_cbor(x):
-    if isinstance(x, (NoneType, bool, int, float, str, bytes)):
+    if isinstance(x, _PRIMITIVE_TYPES):
         return x
     elif isinstance(x, (list, tuple)):
         return [to_cbor(y) for y in x]
     elif isinstance(x, dict):
         # Note: dict keys must be sortable.  Sorting ensures that the hash is
         # consistent even if the dict insertion order varies.
-        return sorted(((to_cbor(k), to_cbor(v)) for k,v in x.items()), key=lambda x: x[0])
+        return sorted(((to_cbor(k), to_cbor(v)) for k,v in x.items()), key=_first)
     elif isinstance(x, datetime):
         return (x.year, x.month, x.day, x.hour, x.minute, x.second, x.microsecond)
     else:
         return x.to_cbor()
 
+_to_cbor_func_cache = {}
+
+def _to_cbor_func(ty):
+    '''Returns a function that converts a value of type `ty` to its CBOR form.
+    This gives the same result as `to_cbor`, but is specialized for `ty`,
+    like `_from_cbor_func`.  Types that can't be specialized fall back to the
+    generic `to_cbor`.'''
+    func = _to_cbor_func_cache.get(ty)
+    if func is None:
+        func = _compile_to_cbor(ty)
+        _to_cbor_func_cache[ty] = func
+    return func
+
+def _compile_to_cbor(ty):
+    kind, origin, args = _type_info(ty)
+    if kind == _KIND_PRIMITIVE:
+        def convert(x):
+            return x
+    elif kind == _KIND_LIST:
+        elem_ty, = args
+        convert_elem = _to_cbor_func(elem_ty)
+        def convert(x):
+            return [convert_elem(y) for y in x]
+    elif kind == _KIND_TUPLE:
+        convert_elems = tuple(_to_cbor_func(t) for t in args)
+        def convert(x):
+            return [f(y) for f, y in zip(convert_elems, x)]
+    elif kind == _KIND_DICT:
+        key_ty, value_ty = args
+        convert_key = _to_cbor_func(key_ty)
+        convert_value = _to_cbor_func(value_ty)
+        def convert(x):
+            return sorted(((convert_key(k), convert_value(v)) for k,v in x.items()),
+                key=_first)
+    elif kind == _KIND_DATETIME:
+        def convert(x):
+            return (x.year, x.month, x.day, x.hour, x.minute, x.second, x.microsecond)
+    elif ty is NodeId:
+        convert = operator.attrgetter('raw')
+    else:
+        # `Any` and unions depend on the runtime type of the value.
+        convert = to_cbor
+    return convert
+
+def _union_candidates(variants, value_type, raw):
+    '''Filter the `(type, func)` pairs in `variants` down to the functions
+    that might accept a value of `value_type`, preserving their order.  This
+    lets union handling skip variants that would certainly fail, instead of
+    raising and catching an exception for each one.  If `raw` is set, values
+    are raw CBOR values as passed to `from_cbor`; otherwise they're Python
+    values as passed to `check_type`.'''
+    seq_types = (list, tuple)
+    candidates = []
+    for ty, func in variants:
+        kind, origin, args = _type_info(ty)
+        if kind == _KIND_PRIMITIVE:
+            ok = issubclass(value_type, ty)
+        elif kind == _KIND_LIST:
+            ok = issubclass(value_type, seq_types if raw else list)
+        elif kind == _KIND_TUPLE:
+            ok = issubclass(value_type, seq_types)
+        elif kind == _KIND_DICT:
+            ok = issubclass(value_type, seq_types if raw else dict)
+        elif kind == _KIND_DATETIME:
+            ok = issubclass(value_type, seq_types if raw else datetime)
+        elif ty is NodeId:
+            ok = issubclass(value_type, bytes if raw else NodeId)
+        else:
+            ok = True
+        if ok:
+            candidates.append(func)
+    return tuple(candidates)
+
 def from_cbor(ty, x):
-    origin = typing.get_origin(ty) or ty
-    if origin in (NoneType, bool, int, float, str, bytes):
-        assert isinstance(x, ty)
-        return x
-    elif origin is list:
-        assert isinstance(x, (list, tuple))
-        elem_ty, = typing.get_args(ty)
-        return [from_cbor(elem_ty, y) for y in x]
-    elif origin is tuple:
-        assert isinstance(x, (list, tuple))
-        elem_tys = typing.get_args(ty)
-        assert len(elem_tys) == len(x)
-        return tuple(from_cbor(t, y) for t, y in zip(elem_tys, x))
-    elif origin is dict:
+    return _from_cbor_func(ty)(x)
+
+_from_cbor_func_cache = {}
+
+def _from_cbor_func(ty):
+    '''Returns a function that converts a raw CBOR value to type `ty`.  The
+    function is specialized for `ty`, with the converters for any nested types
+    resolved up front, and is cached per type.'''
+    func = _from_cbor_func_cache.get(ty)
+    if func is None:
+        func = _compile_from_cbor(ty)
+        _from_cbor_func_cache[ty] = func
+    return func
+
+def _compile_from_cbor(ty):
+    kind, origin, args = _type_info(ty)
+    if kind == _KIND_PRIMITIVE:
+        def convert(x):
+            assert isinstance(x, ty)
+            return x
+    elif kind == _KIND_LIST:
+        elem_ty, = args
+        convert_elem = _from_cbor_func(elem_ty)
+        def convert(x):
+            assert isinstance(x, (list, tuple))
+            return [convert_elem(y) for y in x]
+    elif kind == _KIND_TUPLE:
+        convert_elems = tuple(_from_cbor_func(t) for t in args)
+        def convert(x):
+            assert isinstance(x, (list, tuple))
+            assert len(convert_elems) == len(x)
+            return tuple(f(y) for f, y in zip(convert_elems, x))
+    elif kind == _KIND_DICT:
         # Dicts are serialized as lists of pairs.
-        assert isinstance(x, (list, tuple))
-        key_ty, value_ty = typing.get_args(ty)
-        return {from_cbor(key_ty, k): from_cbor(value_ty, v) for k,v in x}
-    elif origin is datetime:
-        assert isinstance(x, (list, tuple))
-        assert len(x) == 7
-        return datetime(*x)
-    elif origin is typing.Any:
-        return x
-    elif origin is typing.Union:
-        for variant_ty in typing.get_args(ty):
-            try:
-                return from_cbor(variant_ty, x)
-                return
-            except (TypeError, AssertionError):
-                pass
+        key_ty, value_ty = args
+        convert_key = _from_cbor_func(key_ty)
+        convert_value = _from_cbor_func(value_ty)
+        def convert(x):
+            assert isinstance(x, (list, tuple))
+            return {convert_key(k): convert_value(v) for k,v in x}
+    elif kind == _KIND_DATETIME:
+        def convert(x):
+            assert isinstance(x, (list, tuple))
+            assert len(x) == 7
+            return datetime(*x)
+    elif kind == _KIND_ANY:
+        def convert(x):
+            return x
+    elif kind == _KIND_UNION:
+        variants = tuple((t, _from_cbor_func(t)) for t in args)
+        candidates_by_type = {}
+        def convert(x):
+            candidates = candidates_by_type.get(type(x))
+            if candidates is None:
+                candidates = _union_candidates(variants, type(x), raw=True)
+                candidates_by_type[type(x)] = candidates
+            for f in candidates:
+                try:
+                    return f(x)
+                except (TypeError, AssertionError):
+                    pass
     else:
-        return ty.from_cbor(x)
+        convert = ty.from_cbor
+    return convert
 
 def check_type(ty, x):
-    origin = typing.get_origin(ty) or ty
-    if origin in (NoneType, bool, int, float, str, bytes):
-        assert isinstance(x, ty), 'expected %r, but got %r: %r' % (origin, type(x), x)
-    elif origin is list:
-        assert isinstance(x, list), 'expected %r, but got %r: %r' % (origin, type(x), x)
-        elem_ty, = typing.get_args(ty)
-        for y in x:
-            check_type(elem_ty, y)
-    elif origin is tuple:
-        assert isinstance(x, (list, tuple)), 'expected %r, but got %r: %r' % (origin, type(x), x)
-        elem_tys = typing.get_args(ty)
-        assert len(elem_tys) == len(x)
-        for t, y in zip(elem_tys, x):
-            check_type(t, y)
-    elif origin is dict:
-        assert isinstance(x, dict), 'expected %r, but got %r: %r' % (origin, type(x), x)
-        key_ty, value_ty = typing.get_args(ty)
-        for k, v in x.items():
-            check_type(key_ty, k)
-            check_type(value_ty, v)
-    elif origin is datetime:
-        assert isinstance(x, datetime)
-    elif origin is typing.Any:
-        pass
-    elif origin is typing.Union:
-        for variant_ty in typing.get_args(ty):
-            try:
-                check_type(variant_ty, x)
-                return
-            except (TypeError, AssertionError):
-                pass
+    if not __debug__:
+        # Type checks are implemented with `assert`, so they do nothing
+        # under `-O`.  Skip the traversal entirely.
+        return
+    _check_type_func(ty)(x)
+
+_check_type_func_cache = {}
+
+def _check_type_func(ty):
+    '''Returns a function that checks that a value has type `ty`, raising
+    `AssertionError` or `TypeError` if it doesn't.  Like `_from_cbor_func`,
+    the function is specialized for `ty` and cached per type.'''
+    func = _check_type_func_cache.get(ty)
+    if func is None:
+        func = _compile_check_type(ty)
+        _check_type_func_cache[ty] = func
+    return func
+
+def _compile_check_type(ty):
+    kind, origin, args = _type_info(ty)
+    if kind == _KIND_PRIMITIVE:
+        def check(x):
+            assert isinstance(x, ty), 'expected %r, but got %r: %r' % (origin, type(x), x)
+    elif kind == _KIND_LIST:
+        elem_ty, = args
+        check_elem = _check_type_func(elem_ty)
+        def check(x):
+            assert isinstance(x, list), 'expected %r, but got %r: %r' % (origin, type(x), x)
+            for y in x:
+                check_elem(y)
+    elif kind == _KIND_TUPLE:
+        check_elems = tuple(_check_type_func(t) for t in args)
+        def check(x):
+            assert isinstance(x, (list, tuple)), 'expected %r, but got %r: %r' % (origin, type(x), x)
+            assert len(check_elems) == len(x)
+            for f, y in zip(check_elems, x):
+                f(y)
+    elif kind == _KIND_DICT:
+        key_ty, value_ty = args
+        check_key = _check_type_func(key_ty)
+        check_value = _check_type_func(value_ty)
+        def check(x):
+            assert isinstance(x, dict), 'expected %r, but got %r: %r' % (origin, type(x), x)
+            for k, v in x.items():
+                check_key(k)
+                check_value(v)
+    elif kind == _KIND_DATETIME:
+        def check(x):
+            assert isinstance(x, datetime)
+    elif kind == _KIND_ANY:
+        def check(x):
+            pass
+    elif kind == _KIND_UNION:
+        variants = tuple((t, _check_type_func(t)) for t in args)
+        candidates_by_type = {}
+        def check(x):
+            candidates = candidates_by_type.get(type(x))
+            if candidates is None:
+                candidates = _union_candidates(variants, type(x), raw=False)
+                candidates_by_type[type(x)] = candidates
+            for f in candidates:
+                try:
+                    f(x)
+                    return
+                except (TypeError, AssertionError):
+                    pass
     else:
-        return ty.check_type(x)
+        check = ty.check_type
+    return check
+
+_metadata_field_types_cache: dict[type, dict[str, type]] = {}
 
 def _metadata_field_types(cls: type) -> dict[str, type]:
     """
-    Get all of the `Metadata[T]` field types of a type.
+    Get all of the `Metadata[T]` field types of a type.  The result is cached
+    per class and must not be modified.
+    """
+    field_types = _metadata_field_types_cache.get(cls)
+    if field_types is None:
+        field_types = _compute_metadata_field_types(cls)
+        _metadata_field_types_cache[cls] = field_types
+    return field_types
+
+_metadata_fields_cache: dict[type, tuple] = {}
+
+def _metadata_fields(cls: type) -> tuple[
+    frozenset[str],
+    tuple[tuple[str, Callable[[Any], None]], ...],
+    tuple[tuple[str, Callable[[Any], Any]], ...],
+]:
+    """
+    Get the set of `Metadata[T]` field names of a type, along with a tuple of
+    `(name, check)` pairs giving the specialized type checker for each field
+    (see `_check_type_func`) and a tuple of `(name, convert)` pairs, sorted by
+    name, giving the specialized CBOR encoder for each field (see
+    `_to_cbor_func`).  Cached per class.
+    """
+    fields = _metadata_fields_cache.get(cls)
+    if fields is None:
+        field_types = _metadata_field_types(cls)
+        fields = (frozenset(field_types),
+            tuple((name, _check_type_func(ty)) for name, ty in field_types.items()),
+            tuple((name, _to_cbor_func(field_types[name])) for name in sorted(field_types)))
+        _metadata_fields_cache[cls] = fields
+    return fields
+
+_metadata_decoders_cache: dict[type, dict[str, Callable[[Any], Any]]] = {}
+
+def _metadata_decoders(cls: type) -> dict[str, Callable[[Any], Any]]:
     """
+    Get a dict mapping each `Metadata[T]` field name of a type to the
+    specialized `from_cbor` converter for its type (see `_from_cbor_func`).
+    Cached per class.
+    """
+    decoders = _metadata_decoders_cache.get(cls)
+    if decoders is None:
+        decoders = {name: _from_cbor_func(ty)
+            for name, ty in _metadata_field_types(cls).items()}
+        _metadata_decoders_cache[cls] = decoders
+    return decoders
+
+def _compute_metadata_field_types(cls: type) -> dict[str, type]:
     type_hints = typing.get_type_hints(cls, include_extras=True)
     field_types: dict[str, type] = {}
     for field_name, ty in type_hints.items():
@@ -161,20 +456,37 @@ def _dataclass_to_cbor(x):
     '''Convert `x` to a CBOR-serializable form.  This is a default
     implementation for use in classes that have `dataclass`-style typed
     fields.'''
-    cls = x.__class__
-    field_tys = typing.get_type_hints(cls)
-    values = tuple(getattr(x, name) for name in field_tys.keys())
-    return to_cbor(values)
+    get_values, values_ty = _dataclass_fields(x.__class__)
+    return _to_cbor_func(values_ty)(get_values(x))
 
 @classmethod
 def _dataclass_from_cbor(cls, raw):
-    field_tys = typing.get_type_hints(cls)
-    expect_ty = tuple[*field_tys.values()]
+    _, expect_ty = _dataclass_fields(cls)
     values = from_cbor(expect_ty, raw)
     return cls(*values)
 
+_dataclass_fields_cache: dict[type, tuple[Callable[[Any], tuple], type]] = {}
+
+def _dataclass_fields(cls):
+    '''Returns a function that gets the tuple of field values of a `cls`
+    instance, along with a `tuple[...]` type covering all the fields' types.
+    Cached per class.'''
+    fields = _dataclass_fields_cache.get(cls)
+    if fields is None:
+        field_tys = typing.get_type_hints(cls)
+        names = tuple(field_tys.keys())
+        if len(names) == 1:
+            # `attrgetter` with a single name returns a bare value, not a tuple.
+            get_one = operator.attrgetter(names[0])
+            get_values = lambda x: (get_one(x),)
+        else:
+            get_values = operator.attrgetter(*names)
+        fields = (get_values, tuple[*field_tys.values()])
+        _dataclass_fields_cache[cls] = fields
+    return fields
+
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ReflogEntry:
     node_id: NodeId
     timestamp: datetime
@@ -183,7 +495,11 @@ class ReflogEntry:
     to_cbor = _dataclass_to_cbor
     from_cbor = _dataclass_from_cbor
 
-@dataclass(frozen=True)
+# Type of the `(timestamp, reason)` header stored before each node ID in a tag
+# file.
+_REFLOG_HEADER_TYPE = tuple[datetime, Any]
+
+@dataclass(frozen=True, slots=True)
 class IndexEntry:
     node_id: NodeId
     kind: str
@@ -193,55 +509,98 @@ class IndexEntry:
     from_cbor = _dataclass_from_cbor
 
 
+_METADATA_LEAF_TYPES = (NoneType, bool, int, float, str, bytes, datetime)
+
 def _metadata_node_ids(x):
-    if isinstance(x, (NoneType, bool, int, float, str, bytes, datetime)):
-        return
-    elif isinstance(x, NodeId):
-        yield x
-    elif isinstance(x, (list, tuple)):
-        for y in x:
-            yield from _metadata_node_ids(y)
-    elif isinstance(x, dict):
-        for k,v in x.items():
-            yield from _metadata_node_ids(k)
-            yield from _metadata_node_ids(v)
-    else:
-        raise TypeError('unsupported type in metadata: %r' % (type(x),))
+    '''Yields every `NodeId` in the metadata value `x`, in depth-first order.
+    This walks an explicit stack rather than recursing, since it runs on every
+    metadata value during index updates.'''
+    stack = [x]
+    pop = stack.pop
+    extend = stack.extend
+    while stack:
+        x = pop()
+        ty = type(x)
+        if ty is NodeId:
+            yield x
+        elif ty is list or ty is tuple:
+            extend(reversed(x))
+        elif ty is dict:
+            for k, v in reversed(x.items()):
+                stack.append(v)
+                stack.append(k)
+        elif ty in _METADATA_LEAF_TYPES:
+            pass
+        # Slow path for subclasses of the types above.
+        elif isinstance(x, _METADATA_LEAF_TYPES):
+            pass
+        elif isinstance(x, NodeId):
+            yield x
+        elif isinstance(x, (list, tuple)):
+            extend(reversed(x))
+        elif isinstance(x, dict):
+            for k, v in reversed(x.items()):
+                stack.append(v)
+                stack.append(k)
+        else:
+            raise TypeError('unsupported type in metadata: %r' % (type(x),))
 
 
 class MVIR:
     def __init__(self, path, src_dir):
         self._path = path
         self._src_dir = os.path.realpath(src_dir)
-        # Maps `NodeId` to `Node`
+        # Maps `NodeId.raw` to `Node`.  Keying on the raw bytes lets lookups
+        # use the built-in `bytes` hash and comparison.
         self._nodes = WeakValueDictionary()
         self._stamp_mtime_cache = {}
+        # Tag directories known to exist, so `set_tag` can skip `makedirs`.
+        self._tag_dirs = set()
 
     def _node_path(self, node_id):
-        first, rest = node_id.raw[:1].hex(), node_id.raw[1:].hex()
-        return os.path.join(self._path, 'nodes', first, rest)
+        h = node_id.hex()
+        return os.path.join(self._path, 'nodes', h[:2], h[2:])
 
     def node_ids_with_prefix(self, s):
         s = s.lower()
         first, rest = s[:2], s[2:]
         dir_path = os.path.join(self._path, 'nodes', first)
         try:
-            file_names = os.listdir(dir_path)
+            it = os.scandir(dir_path)
         except OSError:
             return []
-        return [NodeId.from_str(first + name) for name in file_names if name.startswith(rest)]
+        name_len = 2 * NodeId.LENGTH - len(first)
+        with it:
+            return [NodeId.intern(bytes.fromhex(first + entry.name)) for entry in it
+                if entry.name.startswith(rest) and len(entry.name) == name_len]
 
     def _nodes_newer_than(self, mtime):
         '''Yields `NodeId`s for all nodes whose file is newer than or equal to
         `mtime`.  If `mtime` is `None`, yields all `NodeId`s that exist on
         disk.'''
         base = os.path.join(self._path, 'nodes')
-        for dir_name in os.listdir(base):
+        # `scandir` avoids building and re-resolving a path for every entry,
+        # and `DirEntry.stat` caches its result.  Entries are collected up
+        # front so that no directory handle stays open while this generator is
+        # suspended.
+        with os.scandir(base) as dir_it:
+            dir_entries = list(dir_it)
+        for dir_entry in dir_entries:
+            dir_name = dir_entry.name
             if dir_name.startswith('.'):
                 continue
-            dir_path = os.path.join(base, dir_name)
+            dir_path = dir_entry.path
+            # Each file's `NodeId` is the directory's byte followed by the
+            # bytes of the file name, so the prefix is decoded only once.
+            try:
+                dir_byte = bytes.fromhex(dir_name)
+            except ValueError:
+                dir_byte = b''
+            if len(dir_byte) != 1:
+                print('warning: unknown directory %r in nodes directory' % (dir_path,))
+                continue
             if mtime is not None:
-                dir_mtime = os.stat(dir_path).st_mtime_ns
+                dir_mtime = dir_entry.stat().st_mtime_ns
                 if dir_mtime < mtime:
                     # Adding a new file to a directory updates the directory
                     # mtime.  Since we don't modify node files after creating
@@ -259,19 +618,28 @@ class MVIR:
                     # we create the node file and when we finish writing to it.
                     continue
 
-            for file_name in os.listdir(dir_path):
+            with os.scandir(dir_path) as file_it:
+                file_entries = list(file_it)
+            for file_entry in file_entries:
+                file_name = file_entry.name
                 if file_name.startswith('.'):
                     continue
-                file_path = os.path.join(dir_path, file_name)
+                file_path = file_entry.path
                 if mtime is not None:
-                    file_mtime = os.stat(file_path).st_mtime_ns
+                    file_mtime = file_entry.stat().st_mtime_ns
                     if file_mtime < mtime:
                         continue
 
                 try:
-                    yield NodeId.from_str(dir_name + file_name)
-                except ValueError as e:
-                    print('warning: unknown file %r in nodes directory (%s)' % (file_path, e))
+                    raw = dir_byte + bytes.fromhex(file_name)
+                except ValueError:
+                    raw = b''
+                if len(raw) != NodeId.LENGTH:
+                    # `fromhex` skips whitespace, so check the decoded length
+                    # rather than the name length.
+                    print('warning: unknown file %r in nodes directory' % (file_path,))
+                    continue
+                yield NodeId.intern(raw)
 
     def node(self, node_id):
         return Node._get(self, node_id)
@@ -284,18 +652,27 @@ class MVIR:
             node_id = node_id.node_id()
 
         path = self._tag_path(name)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'ab') as f:
-            timestamp = datetime.now()
-            cbor.dump(to_cbor((timestamp, reason)), f)
-            f.write(node_id.raw)
+        dir_path = os.path.dirname(path)
+        if dir_path not in self._tag_dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            self._tag_dirs.add(dir_path)
+        timestamp = datetime.now()
+        # The whole reflog entry goes out in one `write`, so concurrent
+        # `set_tag` calls can't interleave their halves.
+        header = _to_cbor_func(_REFLOG_HEADER_TYPE)((timestamp, reason))
+        data = cbor.dumps(header) + node_id.raw
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+        try:
+            _write_all(fd, (data,))
+        finally:
+            os.close(fd)
 
     def tag(self, name):
         path = self._tag_path(name)
         with open(path, 'rb') as f:
             f.seek(-NodeId.LENGTH, os.SEEK_END)
             raw = f.read(NodeId.LENGTH)
-            return NodeId(raw)
+            return NodeId.intern(raw)
 
     def has_tag(self, name):
         path = self._tag_path(name)
@@ -304,12 +681,18 @@ class MVIR:
     def tag_reflog(self, name):
         path = self._tag_path(name)
         reflog = []
-        size = os.stat(path).st_size
+        # Read the whole log at once and decode from memory, rather than
+        # issuing small reads against the file for every entry.
         with open(path, 'rb') as f:
-            while f.tell() < size:
-                timestamp, reason = from_cbor(tuple[datetime, Any], cbor.load(f))
-                node_id = NodeId(f.read(NodeId.LENGTH))
-                reflog.append(ReflogEntry(node_id, timestamp, reason))
+            data = f.read()
+        size = len(data)
+        buf = io.BytesIO(data)
+        load = _cbor_decoder(buf)
+        convert = _from_cbor_func(_REFLOG_HEADER_TYPE)
+        while buf.tell() < size:
+            timestamp, reason = convert(load())
+            node_id = NodeId.intern(buf.read(NodeId.LENGTH))
+            reflog.append(ReflogEntry(node_id, timestamp, reason))
         return reflog
 
     def _stamp_path(self, name):
@@ -320,9 +703,9 @@ class MVIR:
             return self._stamp_mtime_cache[name]
 
         path = self._stamp_path(name)
-        if os.path.exists(path):
+        try:
             mtime = os.stat(path).st_mtime_ns
-        else:
+        except FileNotFoundError:
             mtime = None
         self._stamp_mtime_cache[name] = mtime
         return mtime
@@ -330,17 +713,22 @@ class MVIR:
     def _touch_stamp(self, name, content=b''):
         self._stamp_mtime_cache.pop(name, None)
         path = self._stamp_path(name)
-        if not os.path.exists(path):
+        try:
+            f = open(path, 'wb')
+        except FileNotFoundError:
             os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb') as f:
+            f = open(path, 'wb')
+        with f:
             if len(content) > 0:
                 f.write(content)
 
     def _read_stamp(self, name):
         path = self._stamp_path(name)
-        if not os.path.exists(path):
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
             return b''
-        with open(path, 'rb') as f:
+        with f:
             return f.read()
 
     # Index update logic
@@ -364,10 +752,13 @@ class MVIR:
         # Load the set of nodes that were processed during the last index
         # update.
         prev_bytes = self._read_stamp('index')
-        prev_nodes = set(NodeId(prev_bytes[i : i + NodeId.LENGTH])
-            for i in range(0, len(prev_bytes), NodeId.LENGTH))
+        # This holds raw IDs rather than `NodeId`s, to avoid constructing an
+        # object for every node in the stamp.
+        prev_nodes = {prev_bytes[i : i + NodeId.LENGTH]
+            for i in range(0, len(prev_bytes), NodeId.LENGTH)}
 
-        processed_nodes = bytearray()
+        processed_nodes = []
+        new_ids = []
         for src_id in self._nodes_newer_than(prev_mtime):
             # `src_id` refers to a node with `mtime >= index_mtime`.  We record
             # all such nodes in `processed_nodes`, even if they were previously
@@ -376,27 +767,68 @@ class MVIR:
             # might see these same nodes again, and needs to know that they
             # were already processed (even though they were processed by the
             # previous update, not the current one).
-            processed_nodes.extend(src_id.raw)
+            processed_nodes.append(src_id.raw)
 
-            if src_id in prev_nodes:
+            if src_id.raw in prev_nodes:
                 # Node was already processed.
                 continue
+            new_ids.append(src_id)
 
-            n = self.node(src_id)
+        # Maps destination `NodeId` to a list of encoded `IndexEntry`s.
+        new_entries = {}
+        for n in self._load_nodes(new_ids):
+            src_id = n.node_id()
             for k, v in n.metadata().items():
                 for dest_id in _metadata_node_ids(v):
                     entry = IndexEntry(src_id, n.kind, k)
-
-                    path = self._index_path(dest_id)
-                    os.makedirs(os.path.dirname(path), exist_ok=True)
-                    with open(path, 'ab') as f:
-                        cbor.dump(entry.to_cbor(), f)
-
-        self._touch_stamp('index', processed_nodes)
+                    entry_bytes = cbor.dumps(entry.to_cbor())
+                    new_entries.setdefault(dest_id, []).append(entry_bytes)
+
+        # Write each index file once, appending all of its new entries
+        # together, instead of reopening it for every reference.  Writing in
+        # path order groups the files by directory, and each of the (at most
+        # 256) directories only needs to be created once.
+        ensured_dirs = set()
+        for path, entries in sorted((self._index_path(dest_id), entries)
+                for dest_id, entries in new_entries.items()):
+            dir_path = os.path.dirname(path)
+            if dir_path not in ensured_dirs:
+                os.makedirs(dir_path, exist_ok=True)
+                ensured_dirs.add(dir_path)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+            try:
+                # Entries are tiny, so join them rather than passing
+                # thousands of separate buffers to `writev`.
+                _write_all(fd, (b''.join(entries),))
+            finally:
+                os.close(fd)
+
+        self._touch_stamp('index', b''.join(processed_nodes))
+
+    # Number of threads used by `_load_nodes`, and the number of nodes it
+    # loads at a time.
+    _LOAD_THREADS = 8
+    _LOAD_BATCH_SIZE = 256
+
+    def _load_nodes(self, node_ids):
+        '''Yields the nodes for `node_ids`, in order.  Large batches are read
+        using a thread pool so that the file reads overlap.'''
+        if len(node_ids) < 2 * self._LOAD_THREADS:
+            for node_id in node_ids:
+                yield self.node(node_id)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(self._LOAD_THREADS) as executor:
+            # Load one batch at a time.  `self._nodes` only holds weak
+            # references, so each loaded node is kept alive by its pending
+            # future until it's consumed.
+            for i in range(0, len(node_ids), self._LOAD_BATCH_SIZE):
+                batch = node_ids[i : i + self._LOAD_BATCH_SIZE]
+                yield from executor.map(self.node, batch)
 
     def _index_path(self, node_id):
-        first, rest = node_id.raw[:1].hex(), node_id.raw[1:].hex()
-        return os.path.join(self._path, 'index', first, rest)
+        h = node_id.hex()
+        return os.path.join(self._path, 'index', h[:2], h[2:])
 
     def index(self, node_id):
         '''Get a list of references to `node_id` from the index.  This will
@@ -410,14 +842,112 @@ class MVIR:
         except FileNotFoundError:
             return ()
         with f:
-            entries = []
-            size = os.stat(path).st_size
-            while f.tell() < size:
-                entries.append(IndexEntry.from_cbor(cbor.load(f)))
+            data = f.read()
+        # Decode from memory with a single decoder, as in `tag_reflog`.
+        size = len(data)
+        buf = io.BytesIO(data)
+        load = _cbor_decoder(buf)
+        entries = []
+        while buf.tell() < size:
+            entries.append(IndexEntry.from_cbor(load()))
         return entries
 
 
+# Buffers with a combined size up to this are joined and written with a single
+# `write` by `_write_all`.  Larger ones are written with `writev` instead, to
+# avoid copying them.
+_JOIN_WRITE_MAX = 1024 * 1024
+
+def _iov_max():
+    try:
+        n = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        n = -1
+    # POSIX guarantees at least 16.
+    return n if n > 0 else 16
+
+# Maximum number of buffers passed to a single `writev` call.
+_IOV_MAX = _iov_max()
+
+def _write_all(fd, chunks):
+    '''Write all of the byte strings in `chunks` to the file descriptor `fd`,
+    bypassing Python's buffered I/O layer and retrying after short writes.'''
+    if sum(len(c) for c in chunks) <= _JOIN_WRITE_MAX or not hasattr(os, 'writev'):
+        data = memoryview(b''.join(chunks))
+        while len(data) > 0:
+            data = data[os.write(fd, data):]
+        return
+
+    views = [memoryview(c) for c in chunks if len(c) > 0]
+    i = 0
+    while i < len(views):
+        written = os.writev(fd, views[i : i + _IOV_MAX])
+        while written > 0:
+            if written >= len(views[i]):
+                written -= len(views[i])
+                i += 1
+            else:
+                views[i] = views[i][written:]
+                written = 0
+
+# Node files up to this size are read in full by `Node._get`.  Bodies of
+# larger files are loaded on demand.
+_SINGLE_READ_MAX = 1024 * 1024
+
+# Bodies up to this size are hashed together with the metadata in one call.
+_ONE_SHOT_HASH_MAX = 64 * 1024
+
+# Chunk size for streaming file contents in `FileNode.new_from_path` and
+# `_copy_fd_range`.
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+# Errors from `copy_file_range` or `sendfile` meaning the call isn't supported
+# for the given files, so `_copy_fd_range` should try something else.
+_COPY_FALLBACK_ERRNOS = frozenset((errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+    errno.EOPNOTSUPP, errno.EBADF))
+
+def _copy_fd_range(src_fd, offset, dst_fd, count):
+    '''Copy `count` bytes starting at `offset` in `src_fd` to the current
+    position of `dst_fd`.  This uses `copy_file_range` or `sendfile` where the
+    platform and filesystems allow, so the data doesn't pass through user
+    space, and falls back to `pread` and `write` otherwise.'''
+    start = offset
+    end = offset + count
+    copiers = []
+    if hasattr(os, 'copy_file_range'):
+        copiers.append(lambda pos: os.copy_file_range(src_fd, dst_fd, end - pos, pos))
+    if hasattr(os, 'sendfile'):
+        copiers.append(lambda pos: os.sendfile(dst_fd, src_fd, pos, end - pos))
+    for copy in copiers:
+        try:
+            while offset < end:
+                n = copy(offset)
+                if n == 0:
+                    # Some filesystems report 0 instead of an error when the
+                    # call isn't supported.  Let the `pread` loop below
+                    # finish the copy, or detect a real end of file.
+                    break
+                offset += n
+        except OSError as e:
+            # Only fall back if nothing has been copied yet.  Otherwise, part
+            # of the data has already been written to `dst_fd`.
+            if offset != start or e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+        if offset == end:
+            return
+        if offset != start:
+            break
+    while offset < end:
+        data = os.pread(src_fd, min(end - offset, _COPY_CHUNK_SIZE), offset)
+        if len(data) == 0:
+            raise EOFError('unexpected end of file')
+        _write_all(dst_fd, (data,))
+        offset += len(data)
+
 class Node:
+    __slots__ = ('_mvir', '_node_id', '_metadata', '_body_offset', '_body',
+        '_body_json', '__weakref__')
+
     kind: Metadata[str]
 
     def __init__(self, mvir, node_id, metadata, body_offset):
@@ -431,14 +961,14 @@ class Node:
 
     @classmethod
     def _check_metadata(cls, metadata):
-        field_tys = _metadata_field_types(cls)
+        expected_keys, field_items, _ = _metadata_fields(cls)
 
         if not isinstance(metadata, dict):
             raise TypeError('metadata should be a dict, but got %r (%r)' %
                 (metadata, type(metadata)))
-        if metadata.keys() != field_tys.keys():
-            missing = field_tys.keys() - metadata.keys()
-            unexpected = metadata.keys() - field_tys.keys()
+        if metadata.keys() != expected_keys:
+            missing = expected_keys - metadata.keys()
+            unexpected = metadata.keys() - expected_keys
             if missing and unexpected:
                 raise ValueError('missing keys %r and unexpected keys %r for %s' %
                     (missing, unexpected, cls.__name__))
@@ -448,9 +978,12 @@ class Node:
                 assert unexpected
                 raise ValueError('unexpected keys %r for %s' % (unexpected, cls.__name__))
 
-        for k, v in metadata.items():
+        if not __debug__:
+            # The field checks are all `assert`s, which `-O` disables anyway.
+            return
+        for k, check in field_items:
             try:
-                check_type(field_tys[k], v)
+                check(metadata[k])
             except (AssertionError, TypeError):
                 print('error checking field %r' % k)
                 raise
@@ -466,14 +999,28 @@ class Node:
 
     @staticmethod
     def _create(mvir, metadata, body):
-        meta_bytes = cbor.dumps(to_cbor(metadata))
-        h = hashlib.sha256()
-        h.update(meta_bytes)
-        h.update(body)
-        node_id = NodeId(h.digest())
-
-        body_offset = len(meta_bytes)
+        cls = NODE_KIND_MAP[metadata['kind']]
+        meta_bytes = cbor.dumps(cls._metadata_to_cbor(metadata))
+        if len(body) <= _ONE_SHOT_HASH_MAX:
+            # Hashing a single buffer in one call is cheaper than two `update`s
+            # when copying the body is cheap.  The joined buffer is also what
+            # gets written to disk, so it's only built once.
+            chunks = (meta_bytes + body,)
+            digest = hashlib.sha256(chunks[0]).digest()
+        else:
+            chunks = (meta_bytes, body)
+            h = hashlib.sha256(meta_bytes)
+            h.update(body)
+            digest = h.digest()
+        node_id = NodeId(digest)
+        return Node._store(mvir, cls, node_id, metadata, len(meta_bytes), body,
+            lambda fd: _write_all(fd, chunks))
 
+    @staticmethod
+    def _store(mvir, cls, node_id, metadata, body_offset, body, write):
+        '''Return the node `node_id` of class `cls`, calling `write(fd)` to
+        write its file contents to a new file if it isn't stored yet.  `body`
+        may be `None`, in which case it's loaded from disk on demand.'''
         def populate(n):
             if n._metadata is None:
                 n._metadata = metadata
@@ -482,20 +1029,19 @@ class Node:
             if n._body is None:
                 n._body = body
 
-        if node_id in mvir._nodes:
-            n = mvir._nodes[node_id]
+        n = mvir._nodes.get(node_id.raw)
+        if n is not None:
             # If some parts haven't been loaded from disk yet, populate them
             # with the values we hav eavailable.
             populate(n)
             return n
 
         path = mvir._node_path(node_id)
-        cls = NODE_KIND_MAP[metadata['kind']]
         n = cls(mvir, node_id, metadata, body_offset)
         populate(n)
         if os.path.exists(path):
             # No need to write if the file already exists.
-            mvir._nodes[node_id] = n
+            mvir._nodes[node_id.raw] = n
             return n
 
         # Bump the `nodes` timestamp file before writing the new node to disk.
@@ -505,14 +1051,17 @@ class Node:
         mvir._touch_stamp('nodes')
 
         dir_path = os.path.dirname(path)
-        os.makedirs(dir_path, exist_ok=True)
-        tmp_fd, tmp_path = tempfile.mkstemp(dir=dir_path)
+        try:
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=dir_path)
+        except FileNotFoundError:
+            os.makedirs(dir_path, exist_ok=True)
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=dir_path)
 
         try:
-            with os.fdopen(tmp_fd, 'wb') as f:
-                f.write(meta_bytes)
-                assert f.tell() == n._body_offset
-                f.write(body)
+            try:
+                write(tmp_fd)
+            finally:
+                os.close(tmp_fd)
             # chmod 444
             os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
             os.rename(tmp_path, path)
@@ -522,29 +1071,45 @@ class Node:
                 os.unlink(tmp_path)
 
         # Update `_nodes` only once we know the write to disk has succeeded.
-        mvir._nodes[node_id] = n
+        mvir._nodes[node_id.raw] = n
         return n
 
+    @classmethod
+    def _metadata_to_cbor(cls, metadata):
+        '''Convert `metadata` to its CBOR form.  This is equivalent to
+        `to_cbor(metadata)`, given that `metadata` has passed
+        `_check_metadata`.'''
+        _, _, field_encoders = _metadata_fields(cls)
+        return [(name, convert(metadata[name])) for name, convert in field_encoders]
+
     @classmethod
     def _metadata_from_cbor(cls, dct):
-        field_tys = _metadata_field_types(cls)
-        metadata = {}
-        for name, value in dct.items():
-            assert name not in metadata
-            ty = field_tys[name]
-            metadata[name] = from_cbor(ty, value)
-        assert metadata.keys() == field_tys.keys()
+        decoders = _metadata_decoders(cls)
+        metadata = {name: decoders[name](value) for name, value in dct.items()}
+        assert metadata.keys() == decoders.keys()
         return metadata
 
     @classmethod
     def _get(cls, mvir, node_id):
-        if node_id in mvir._nodes:
-            return mvir._nodes[node_id]
+        n = mvir._nodes.get(node_id.raw)
+        if n is not None:
+            return n
         else:
             path = mvir._node_path(node_id)
             with open(path, 'rb') as f:
-                metadata = cbor.load(f)
-                body_offset = f.tell()
+                if os.fstat(f.fileno()).st_size <= _SINGLE_READ_MAX:
+                    # Read the whole file at once, decode the metadata from
+                    # memory, and keep the rest as the body, so that
+                    # `_load_body` never needs to reopen the file.
+                    data = f.read()
+                    buf = io.BytesIO(data)
+                    metadata = cbor.load(buf)
+                    body_offset = buf.tell()
+                    body = data[body_offset:]
+                else:
+                    metadata = cbor.load(f)
+                    body_offset = f.tell()
+                    body = None
             metadata = {k: v for k,v in metadata}
 
             cls_name = metadata.get('kind')
@@ -570,7 +1135,8 @@ class Node:
 
             metadata = cls._metadata_from_cbor(metadata)
             n = cls(mvir, node_id, metadata, body_offset)
-            mvir._nodes[node_id] = n
+            n._body = body
+            mvir._nodes[node_id.raw] = n
             return n
 
     def _load_body(self):
@@ -599,18 +1165,100 @@ class Node:
             self._load_body()
         return self._body
 
+    def write_body(self, fd):
+        '''Write the body to the file descriptor `fd`.  If the body isn't
+        loaded yet, it's copied straight from the node file without being read
+        into memory.'''
+        if self._body is not None:
+            _write_all(fd, (self._body,))
+            return
+        path = self._mvir._node_path(self._node_id)
+        src_fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(src_fd).st_size - self._body_offset
+            _copy_fd_range(src_fd, self._body_offset, fd, size)
+        finally:
+            os.close(src_fd)
+
     def body_str(self):
         return self.body().decode('utf-8')
 
     def body_json(self):
         if self._body_json is None:
-            self._body_json = json.loads(self.body().decode('utf-8'))
+            self._body_json = _json_loads(self.body())
         return self._body_json
 
 class FileNode(Node):
+    __slots__ = ()
     KIND = 'file'
 
+    @classmethod
+    def new_from_path(cls, mvir, path):
+        '''Create a `FileNode` with the contents of the file at `path`.
+        Large files are streamed from disk in chunks rather than read into
+        memory all at once.'''
+        with open(path, 'rb') as f:
+            return cls.new_from_file(mvir, f)
+
+    @classmethod
+    def new_from_file(cls, mvir, f):
+        '''Like `new_from_path`, but reads from `f`, a binary file opened
+        for reading, starting from the beginning of the file.'''
+        f.seek(0)
+        st = os.fstat(f.fileno())
+        if st.st_size <= _SINGLE_READ_MAX:
+            return cls.new(mvir, f.read())
+
+        metadata = {'kind': cls.KIND}
+        cls._check_metadata(metadata)
+        meta_bytes = cbor.dumps(cls._metadata_to_cbor(metadata))
+        h = hashlib.sha256(meta_bytes)
+        buf = memoryview(bytearray(_COPY_CHUNK_SIZE))
+        while n := f.readinto(buf):
+            h.update(buf[:n])
+        node_id = NodeId(h.digest())
+
+        def write(fd):
+            _write_all(fd, (meta_bytes,))
+            # Copy the body in the kernel where possible.  `_copy_fd_range`
+            # uses explicit offsets, so the position of `f` doesn't matter.
+            _copy_fd_range(f.fileno(), 0, fd, st.st_size)
+            # The file was read twice, so make sure it didn't change in
+            # between.  Otherwise the stored contents might not match
+            # `node_id`.
+            st2 = os.fstat(f.fileno())
+            if (st2.st_size, st2.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+                raise OSError('file %r changed while it was being read' % (f.name,))
+
+        return Node._store(mvir, cls, node_id, metadata, len(meta_bytes), None, write)
+
+    # Number of threads used by `new_many`, and the number of bodies it keeps
+    # in flight at once.
+    _NEW_MANY_THREADS = 8
+    _NEW_MANY_PENDING = 64
+
+    @classmethod
+    def new_many(cls, mvir, items):
+        '''Create a `FileNode` for each `(key, body)` pair in `items`, and
+        return a dict mapping each key to the new node's `NodeId`.  Bodies are
+        hashed and written on a thread pool (`hashlib` and file writes release
+        the GIL), which overlaps with the caller's work in producing `items`,
+        such as reading a tar archive.  At most `_NEW_MANY_PENDING` bodies are
+        held at once.'''
+        result = {}
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(cls._NEW_MANY_THREADS) as executor:
+            for key, body in items:
+                if len(pending) >= cls._NEW_MANY_PENDING:
+                    k, fut = pending.popleft()
+                    result[k] = fut.result().node_id()
+                pending.append((key, executor.submit(cls.new, mvir, body)))
+            for k, fut in pending:
+                result[k] = fut.result().node_id()
+        return result
+
 class TreeNode(Node):
+    __slots__ = ()
     KIND = 'tree'
     files: Metadata[dict[str, NodeId]]
 
@@ -630,6 +1278,7 @@ class TreeNode(Node):
     files = property(lambda self: self._metadata['files'])
 
 class CompileCommandsOpNode(Node):
+    __slots__ = ()
     KIND = 'compile_commands_op_v2'
     c_code: Metadata[NodeId]
     cmds: Metadata[list[list[str]]]
@@ -642,6 +1291,7 @@ class CompileCommandsOpNode(Node):
     compile_commands = property(lambda self: self._metadata['compile_commands'])
 
 class TranspileOpNode(Node):
+    __slots__ = ()
     KIND = 'transpile_op'
     compile_commands: Metadata[NodeId]
     c_code: Metadata[NodeId]
@@ -656,6 +1306,7 @@ class TranspileOpNode(Node):
     rust_code = property(lambda self: self._metadata['rust_code'])
 
 class SplitFfiOpNode(Node):
+    __slots__ = ()
     KIND = 'split_ffi_op_v2'
     old_code: Metadata[NodeId]
     new_code: Metadata[NodeId]
@@ -665,6 +1316,7 @@ class SplitFfiOpNode(Node):
     new_code = property(lambda self: self._metadata['new_code'])
 
 class LlmOpNode(Node):
+    __slots__ = ()
     KIND = 'llm_op'
     old_code: Metadata[NodeId]
     new_code: Metadata[NodeId]
@@ -687,6 +1339,7 @@ class LlmOpNode(Node):
     response = property(lambda self: self._metadata['response'])
 
 class CodexAgentOpNode(Node):
+    __slots__ = ()
     KIND = 'codex_agent_op_v2'
     old_code: Metadata[NodeId]
     new_code: Metadata[NodeId]
@@ -710,6 +1363,7 @@ class CodexAgentOpNode(Node):
     planning_files = property(lambda self: self._metadata['planning_files'])
 
 class CodexReviewOpNode(Node):
+    __slots__ = ()
     KIND = 'codex_review_op'
     old_code: Metadata[NodeId]
     new_code: Metadata[NodeId]
@@ -727,6 +1381,7 @@ class CodexReviewOpNode(Node):
     verdict = property(lambda self: self._metadata['verdict'])
 
 class TestResultNode(Node):
+    __slots__ = ()
     KIND = 'test_result_node'
     code: Metadata[NodeId]
     # `test_code` is a `TreeNode` containing additional code used only for
@@ -746,6 +1401,7 @@ class TestResultNode(Node):
         return self.exit_code == 0
 
 class CargoCheckJsonAnalysisNode(Node):
+    __slots__ = ()
     KIND = 'cargo_check_json_analysis_node'
     code: Metadata[NodeId]
     exit_code: Metadata[int]
@@ -761,6 +1417,7 @@ class CargoCheckJsonAnalysisNode(Node):
         return self.exit_code == 0
 
 class InlineErrorsOpNode(Node):
+    __slots__ = ()
     KIND = 'inline_errors_op_node'
     old_code: Metadata[NodeId]
     new_code: Metadata[NodeId]
@@ -771,6 +1428,7 @@ class InlineErrorsOpNode(Node):
     check_json = property(lambda self: self._metadata['check_json'])
 
 class FindUnsafeAnalysisNode(Node):
+    __slots__ = ()
     KIND = 'find_unsafe_analysis_v2'
     code: Metadata[NodeId]
     cmd: Metadata[list[str]]
@@ -784,6 +1442,7 @@ class FindUnsafeAnalysisNode(Node):
     stderr = property(lambda self: self._metadata['stderr'])
 
 class FindUnsafe2AnalysisNode(Node):
+    __slots__ = ()
     KIND = 'find_unsafe2_analysis'
     code: Metadata[NodeId]
     cmd: Metadata[list[str]]
@@ -798,6 +1457,7 @@ class FindUnsafe2AnalysisNode(Node):
     unsafe_json = property(lambda self: self._metadata['unsafe_json'])
 
 class CheckUnsafe2AnalysisNode(Node):
+    __slots__ = ()
     KIND = 'check_unsafe2_analysis'
     code: Metadata[NodeId]
     # `TreeNode` containing the previous JSON files to compare against
@@ -812,6 +1472,7 @@ class CheckUnsafe2AnalysisNode(Node):
     exit_code = property(lambda self: self._metadata['exit_code'])
 
 class EditOpNode(Node):
+    __slots__ = ()
     KIND = 'edit_op'
     old_code: Metadata[NodeId]
     new_code: Metadata[NodeId]
@@ -821,6 +1482,7 @@ class EditOpNode(Node):
     new_code = property(lambda self: self._metadata['new_code'])
 
 class CargoFixOpNode(Node):
+    __slots__ = ()
     KIND = 'cargo_fix_op'
     old_code: Metadata[NodeId]
     # `new_code` equals `old_code` when the fix failed or changed nothing.
@@ -836,10 +1498,12 @@ class CargoFixOpNode(Node):
 
 
 class DefNode(Node):
+    __slots__ = ()
     KIND = 'def'
     # `body` stores the source code of this def
 
 class CrateNode(Node):
+    __slots__ = ()
     KIND = 'crate'
     # Maps each def ID/path to a `DefNode`
     defs: Metadata[dict[str, NodeId]]
@@ -851,6 +1515,7 @@ class SplitOpNode(Node):
     Split a `TreeNode` containing Rust code into a collection of separate
     `DefNode`s.
     '''
+    __slots__ = ()
     KIND = 'split_op'
     cmd: Metadata[list[str]]
     exit_code: Metadata[int]
@@ -873,6 +1538,7 @@ class MergeOpNode(Node):
     to contain the provided definitions, and produces a new `TreeNode` as
     output.
     '''
+    __slots__ = ()
     KIND = 'merge_op'
     cmd: Metadata[list[str]]
     exit_code: Metadata[int]
@@ -895,6 +1561,7 @@ class RelatedDeclsOpNode(Node):
     Process Rust code to identify all declarations that are related to
     `query_def_names`.
     '''
+    __slots__ = ()
     KIND = 'related_decls_op'
     cmd: Metadata[list[str]]
     exit_code: Metadata[int]
@@ -922,6 +1589,7 @@ class RelatedDeclsOpNode(Node):
 
 
 class WorkflowStepInputsNode(Node):
+    __slots__ = ()
     KIND = 'workflow_step_inputs'
     func_name: Metadata[str]
     # `body` stores the CBOR encoding of the step arguments
@@ -929,6 +1597,7 @@ class WorkflowStepInputsNode(Node):
     func_name = property(lambda self: self._metadata['func_name'])
 
 class WorkflowStepNode(Node):
+    __slots__ = ()
     KIND = 'workflow_step'
     inputs: Metadata[NodeId]
     output: Metadata[NodeId]
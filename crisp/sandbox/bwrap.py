@@ -10,7 +10,7 @@ import toml
 from subprocess import CompletedProcess, Popen
 
 from ..config import ConfigBase
-from ..mvir import FileNode, TreeNode
+from ..mvir import FileNode, NodeId, TreeNode
 from ..work_dir import lock_work_dir
 from ..util import ChunkPrinter
 
@@ -73,6 +73,9 @@ class BwrapSandbox:
     def checkout(self, n_tree: TreeNode):
         self.work_dir.checkout(n_tree)
 
+    def checkout_many(self, files: dict[str, NodeId]):
+        self.work_dir.checkout_many(files)
+
     def checkout_file(self, rel_path, n_file: FileNode):
         self.work_dir.checkout_file(rel_path, n_file)
 
@@ -0,0 +1,84 @@
+"""
+Helpers shared by the sandbox implementations.
+"""
+
+from collections import Counter
+import os
+from pathspec.pathspec import PathSpec
+import tarfile
+
+from ..mvir import FileNode
+
+
+def iter_file_bodies(mvir, files):
+    """
+    Yield `(rel_path, body)` for each entry in `files`, a dict mapping
+    relative paths to `FileNode` IDs.  Bodies of files that
+    appear at several paths are loaded once and kept until the last of those
+    paths; other bodies are only held while they're being consumed.
+    """
+    counts = Counter(files.values())
+    shared = {}
+    for rel_path, n_file_id in files.items():
+        if counts[n_file_id] == 1:
+            yield rel_path, mvir.node(n_file_id).body()
+            continue
+        body = shared.get(n_file_id)
+        if body is None:
+            body = mvir.node(n_file_id).body()
+            shared[n_file_id] = body
+        counts[n_file_id] -= 1
+        if counts[n_file_id] == 0:
+            del shared[n_file_id]
+        yield rel_path, body
+
+
+def commit_tar_stream(mvir, tar_file, dest_prefix, ignore_spec: PathSpec | None,
+        commit_file):
+    """
+    Create a `FileNode` for each file in the tar archive read from `tar_file`,
+    and return a dict mapping each file's path to its `NodeId`.  Paths are the
+    archive member names joined onto `dest_prefix`.
+
+    The archive is read as a stream, so the caller doesn't need to buffer it.
+    Since `tarfile` can't seek back to extract a hard link's target, links are
+    resolved after all regular files have been committed.  If a link's target
+    was excluded by `ignore_spec`, its contents were never read, so the link is
+    fetched by calling `commit_file(dest_path)`, which should return a
+    `NodeId`.
+    """
+    # Hard links, as `(dest_path, target member name)` pairs.
+    links = []
+    # Maps archive member names to their `dest_path`.
+    member_paths = {}
+    seen = set()
+
+    def iter_files(t):
+        while (info := t.next()) is not None:
+            if ignore_spec is not None and ignore_spec.match_file(info.name):
+                continue
+            if info.type == tarfile.DIRTYPE:
+                continue
+            dest_path = os.path.normpath(os.path.join(dest_prefix, info.name))
+            assert dest_path not in seen, 'duplicate entry for %s' % dest_path
+            seen.add(dest_path)
+            match info.type:
+                case tarfile.REGTYPE:
+                    member_paths[info.name] = dest_path
+                    yield dest_path, t.extractfile(info).read()
+                case tarfile.LNKTYPE:
+                    # Extract hard links for now, cargo creates some
+                    links.append((dest_path, info.linkname))
+                case ty:
+                    raise ValueError(f"expected REGTYPE, LNKTYPE or DIRTYPE, but got {ty} for file {info.name}")
+
+    with tarfile.open(fileobj=tar_file, mode='r|') as t:
+        files = FileNode.new_many(mvir, iter_files(t))
+
+    for dest_path, link_name in links:
+        target_path = member_paths.get(link_name)
+        if target_path is not None:
+            files[dest_path] = files[target_path]
+        else:
+            files[dest_path] = commit_file(dest_path)
+    return files
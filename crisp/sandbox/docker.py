@@ -1,18 +1,28 @@
+import concurrent.futures
 from contextlib import contextmanager
 import docker
 import io
 import os
 from pathspec.pathspec import PathSpec
+import shutil
 import sys
 import tarfile
+import tempfile
 import shlex
 
 from ..mvir import FileNode, TreeNode
-from ..util import ChunkPrinter
+from ..util import ChunkPrinter, IterReader, iter_tar
+from ..work_dir import WorkDir
+from .common import commit_tar_stream, iter_file_bodies
 
 
 DEFAULT_DOCKER_IMAGE = 'tractor-crisp-user'
 DOCKER_IMAGE_ENV_VAR = 'CRISP_DOCKER_IMAGE'
+# If set to `1`, bind-mount a host directory as the container's work directory
+# instead of copying files in and out as tar archives.  This requires a
+# runtime where files created by the container's root user are owned by the
+# host user, such as rootless Podman.
+DOCKER_BIND_WORK_DIR_ENV_VAR = 'CRISP_DOCKER_BIND_WORK_DIR'
 
 
 class WorkContainer:
@@ -35,79 +45,141 @@ class WorkContainer:
             print(f'error getting image `{image_name}` - you may need to build it first')
             raise
         self.container = None
+        # If the work directory is bind-mounted, this is a `WorkDir` for its
+        # host side, and checkouts and commits go through it directly.
+        self.work_dir = None
+        # Checkouts are uploaded on a background thread, one at a time and in
+        # order.  `_wait_checkouts` must be called before any other request
+        # to the container.
+        self._checkout_executor = None
+        self._pending_checkouts = []
 
     def start(self):
+        volumes = {}
+        if os.environ.get(DOCKER_BIND_WORK_DIR_ENV_VAR) == '1':
+            stage_dir = tempfile.mkdtemp(prefix='crisp_work_')
+            # The container can write anything to this directory, so don't
+            # let a symlink it creates point a checkout or commit at a host
+            # file.
+            self.work_dir = WorkDir(self.mvir, stage_dir, follow_symlinks=False)
+            volumes[stage_dir] = {'bind': '/root/work', 'mode': 'rw'}
         self.container = self.client.containers.run(
-                self.image, ('sleep', '1000'), detach=True, remove=True)
+                self.image, ('sleep', '1000'), detach=True, remove=True,
+                volumes=volumes)
+        self._checkout_executor = concurrent.futures.ThreadPoolExecutor(1)
 
     def stop(self):
-        if self.container is not None:
-            self.container.stop(timeout=1)
-            #self.container.remove(v=True)
+        try:
+            self._finish_checkouts()
+        finally:
+            if self.container is not None:
+                if self.work_dir is not None:
+                    # Under rootful Docker, files written by the container are
+                    # owned by root, so delete them from inside first.
+                    try:
+                        self.container.exec_run(
+                            ['find', '/root/work', '-mindepth', '1', '-delete'])
+                    except docker.errors.APIError as e:
+                        print(f'warning: failed to clean up work dir: {e}',
+                            file=sys.stderr)
+                self.container.stop(timeout=1)
+                #self.container.remove(v=True)
+            if self.work_dir is not None:
+                shutil.rmtree(self.work_dir.path, ignore_errors=True)
+                if os.path.exists(self.work_dir.path):
+                    print(f'warning: failed to remove work dir {self.work_dir.path!r}',
+                        file=sys.stderr)
+
+    def _checkout_tar_file(self, tar_data):
+        """
+        Extract a tar archive into the work directory.  `tar_data` can be
+        `bytes` or an iterable of `bytes` chunks, which is streamed to the
+        container.  This returns before the upload finishes; generating the
+        archive (including reading file bodies from MVIR) and sending it
+        happen on the checkout thread while the caller continues.
+        """
+        def upload():
+            self.container.exec_run("mkdir -p /root/work")
+            self.container.put_archive('/root/work/', tar_data)
+        self._pending_checkouts.append(self._checkout_executor.submit(upload))
 
-    def _checkout_tar_file(self, tar_bytes):
-        self.container.exec_run("mkdir -p /root/work")
-        self.container.put_archive('/root/work/', tar_bytes)
+    def _wait_checkouts(self):
+        """
+        Wait for all pending checkouts to finish, raising the first error
+        from any of them.
+        """
+        pending, self._pending_checkouts = self._pending_checkouts, []
+        for fut in pending:
+            fut.result()
+
+    def _finish_checkouts(self):
+        """
+        Wait for all pending checkouts and shut down the checkout thread.
+        This reports any failed upload that no later call has waited for.
+        """
+        try:
+            self._wait_checkouts()
+        finally:
+            if self._checkout_executor is not None:
+                self._checkout_executor.shutdown()
 
     def checkout(self, n_tree):
         assert isinstance(n_tree, TreeNode)
-        tar_io = io.BytesIO()
-        with tarfile.open(fileobj=tar_io, mode='w') as t:
-            for rel_path, n_file_id in n_tree.files.items():
-                n_file = self.mvir.node(n_file_id)
-                info = tarfile.TarInfo(rel_path)
-                info.size = len(n_file.body())
-                t.addfile(info, io.BytesIO(n_file.body()))
-        self._checkout_tar_file(tar_io.getvalue())
+        self.checkout_many(n_tree.files)
+
+    def checkout_many(self, files):
+        """
+        Check out each file in `files`, a dict mapping relative paths to
+        `FileNode` IDs, using a single archive.
+        """
+        if self.work_dir is not None:
+            # Like `put_archive`, replace any files that already exist.
+            self.work_dir.checkout_many(files, overwrite=True)
+            return
+        self._checkout_tar_file(iter_tar(iter_file_bodies(self.mvir, files)))
 
     def checkout_file(self, rel_path, n_file):
         assert isinstance(n_file, FileNode)
+        if self.work_dir is not None:
+            self.work_dir.checkout_file(rel_path, n_file, overwrite=True)
+            return
         self.checkout_file_untracked(rel_path, n_file.body())
 
     def checkout_file_untracked(self, rel_path, body):
         assert not os.path.isabs(rel_path)
         assert isinstance(body, bytes)
-        tar_io = io.BytesIO()
-        with tarfile.open(fileobj=tar_io, mode='w') as t:
-            info = tarfile.TarInfo(rel_path)
-            info.size = len(body)
-            t.addfile(info, io.BytesIO(body))
-        self._checkout_tar_file(tar_io.getvalue())
+        if self.work_dir is not None:
+            self.work_dir.checkout_file_untracked(rel_path, body, overwrite=True)
+            return
+        self._checkout_tar_file(iter_tar(((rel_path, body),)))
 
     def commit_dir(self, rel_path, ignore_spec: PathSpec | None = None):
         assert not os.path.isabs(rel_path)
+        if self.work_dir is not None:
+            return self.work_dir.commit_dir(rel_path, ignore_spec)
+        self._wait_checkouts()
         tar_bytes_iter, st = self.container.get_archive(self.join(rel_path))
-        tar_bytes = b''.join(tar_bytes_iter)
-        tar_io = io.BytesIO(tar_bytes)
-        files = {}
+        # Parse the archive as it arrives rather than joining it into one
+        # buffer first.
+        tar_file = IterReader(tar_bytes_iter)
         # If the user calls `commit_dir('foo/bar'), we want to produce a
         # `TreeNode` with file names like `foo/bar/README.txt`.  However, the
         # paths returned by `get_archive` are prefixed with just the basename
         # of the requested path, like `bar/README.txt`.  We add this prefix to
         # get the desired path.
         dest_prefix = os.path.dirname(rel_path)
-        with tarfile.open(fileobj=tar_io, mode='r') as t:
-            while (info := t.next()) is not None:
-                if ignore_spec is not None and ignore_spec.match_file(info.name):
-                    continue
-                match info.type:
-                    case tarfile.REGTYPE:
-                        pass
-                    case tarfile.LNKTYPE:
-                        # Extract hard links for now, cargo creates some
-                        pass
-                    case tarfile.DIRTYPE:
-                        continue
-                    case t:
-                        raise ValueError(f"expected REGTYPE, LNKTYPE or DIRTYPE, but got {t} for file {info.name}")
-                f = t.extractfile(info)
-                dest_path = os.path.normpath(os.path.join(dest_prefix, info.name))
-                assert dest_path not in files, 'duplicate entry for %s' % dest_path
-                files[dest_path] = FileNode.new(self.mvir, f.read()).node_id()
+        files = commit_tar_stream(self.mvir, tar_file, dest_prefix, ignore_spec,
+            lambda path: self.commit_file(path).node_id())
+        # Consume the rest of the response, such as padding after the
+        # end-of-archive marker.
+        tar_file.read()
         return TreeNode.new(self.mvir, files=files)
 
     def commit_file(self, rel_path):
         assert not os.path.isabs(rel_path)
+        if self.work_dir is not None:
+            return self.work_dir.commit_file(rel_path)
+        self._wait_checkouts()
         tar_bytes_iter, st = self.container.get_archive(self.join(rel_path))
         tar_bytes = b''.join(tar_bytes_iter)
         tar_io = io.BytesIO(tar_bytes)
@@ -129,6 +201,8 @@ class WorkContainer:
             assert isinstance(cmd, str)
             cmd = ['sh', '-c', cmd]
 
+        self._wait_checkouts()
+
         print(f"cd {shlex.quote(self.join(cwd))} && {shlex.join(cmd)}")
 
         if isinstance(cmd, tuple):
@@ -187,6 +261,9 @@ def run_work_container(cfg, mvir):
         wc.stop()
     else:
         print('keeping work container %r' % (wc.container.name,))
+        if wc.work_dir is not None:
+            print('keeping work dir %r' % (wc.work_dir.path,))
+        wc._finish_checkouts()
 
 def set_keep_work_container(keep):
     global KEEP_WORK_CONTAINER
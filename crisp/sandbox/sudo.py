@@ -1,16 +1,15 @@
 from contextlib import contextmanager
-import io
 import os
 from pathspec.pathspec import PathSpec
 import pwd
 import shlex
 import subprocess
 import sys
-import tarfile
 from subprocess import CompletedProcess, Popen
 
 from ..mvir import FileNode, TreeNode
-from ..util import ChunkPrinter
+from ..util import ChunkPrinter, iter_tar
+from .common import commit_tar_stream, iter_file_bodies
 
 
 class SudoSandbox:
@@ -56,14 +55,39 @@ class SudoSandbox:
 
     def checkout(self, n_tree):
         assert isinstance(n_tree, TreeNode)
-        tar_io = io.BytesIO()
-        with tarfile.open(fileobj=tar_io, mode='w') as t:
-            for rel_path, n_file_id in n_tree.files.items():
-                n_file = self.mvir.node(n_file_id)
-                info = tarfile.TarInfo(rel_path)
-                info.size = len(n_file.body())
-                t.addfile(info, io.BytesIO(n_file.body()))
-        self._run_sudo(('tar', '-C', self.dir_path, '-x'), input=tar_io.getvalue())
+        self.checkout_many(n_tree.files)
+
+    def checkout_many(self, files):
+        """
+        Check out each file in `files`, a dict mapping relative paths to
+        `FileNode` IDs, using a single `tar` process.
+        """
+        files = iter_file_bodies(self.mvir, files)
+        # Stream the archive into `tar` as it's generated, rather than
+        # building the whole thing in memory first.
+        cmd = ('tar', '-C', self.dir_path, '-x')
+        p = self._popen_sudo(cmd, stdin=subprocess.PIPE)
+        # If `tar` exits early, writing to or closing its stdin fails with
+        # `BrokenPipeError`.  Its exit status is more informative, so that's
+        # reported instead when it's nonzero.
+        pipe_error = None
+        try:
+            try:
+                for chunk in iter_tar(files):
+                    p.stdin.write(chunk)
+            except BrokenPipeError as e:
+                pipe_error = e
+            finally:
+                try:
+                    p.stdin.close()
+                except BrokenPipeError as e:
+                    pipe_error = pipe_error or e
+        finally:
+            p.wait()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+        if pipe_error is not None:
+            raise pipe_error
 
     def checkout_file(self, rel_path, n_file):
         assert not os.path.isabs(rel_path)
@@ -77,28 +101,20 @@ class SudoSandbox:
 
     def commit_dir(self, rel_path, ignore_spec: PathSpec | None = None):
         assert not os.path.isabs(rel_path)
-        p = self._run_sudo(('tar', '-C', self.join(rel_path), '-c', '.'), stdout=subprocess.PIPE)
-        tar_bytes = p.stdout
-        tar_io = io.BytesIO(tar_bytes)
-        files = {}
-        with tarfile.open(fileobj=tar_io, mode='r') as t:
-            while (info := t.next()) is not None:
-                if ignore_spec is not None and ignore_spec.match_file(info.name):
-                    continue
-                match info.type:
-                    case tarfile.REGTYPE:
-                        pass
-                    case tarfile.LNKTYPE:
-                        # Extract hard links for now, cargo creates some
-                        pass
-                    case tarfile.DIRTYPE:
-                        continue
-                    case t:
-                        raise ValueError(f"expected REGTYPE, LNKTYPE or DIRTYPE, but got {t} for file {info.name}")
-                f = t.extractfile(info)
-                # Prefix output paths with the requested `rel_path`.
-                dest_path = os.path.normpath(os.path.join(rel_path, info.name))
-                files[dest_path] = FileNode.new(self.mvir, f.read()).node_id()
+        # Parse the archive as `tar` produces it, rather than capturing all of
+        # its output first.
+        cmd = ('tar', '-C', self.join(rel_path), '-c', '.')
+        p = self._popen_sudo(cmd, stdout=subprocess.PIPE)
+        try:
+            files = commit_tar_stream(self.mvir, p.stdout, rel_path, ignore_spec,
+                lambda path: self.commit_file(path).node_id())
+            # Consume any padding after the end-of-archive marker.
+            p.stdout.read()
+        finally:
+            p.stdout.close()
+            p.wait()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
         return TreeNode.new(self.mvir, files=files)
 
     def commit_file(self, rel_path):
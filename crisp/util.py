@@ -1,4 +1,6 @@
+import io
 import sys
+import tarfile
 import time
 
 class ChunkPrinter:
@@ -23,6 +25,8 @@ class ChunkPrinter:
         self.at_bol = True
         self.count = 0
         self.count_width = count_width
+        self._time_sec = None
+        self._time_str = None
 
     def __enter__(self):
         pass
@@ -43,9 +47,17 @@ class ChunkPrinter:
         print()
         self.at_bol = True
 
+    def _tag(self):
+        # Output can arrive many lines per second, so only reformat the
+        # timestamp when the second changes.
+        sec = int(time.time())
+        if sec != self._time_sec:
+            self._time_str = time.strftime('%H:%M:%S', time.localtime(sec))
+            self._time_sec = sec
+        return '[%s %*d] ' % (self._time_str, self.count_width, self.count)
+
     def _emit_tag(self):
-        time_str = time.strftime('%H:%M:%S')
-        sys.stdout.write('[%s %*d] ' % (time_str, self.count_width, self.count))
+        sys.stdout.write(self._tag())
         self.at_bol = False
 
     def _emit_chunk(self, s):
@@ -58,26 +70,38 @@ class ChunkPrinter:
         sys.stdout.write(s)
 
     def write(self, s):
-        parts = s.split('\n')
-        for part in parts[:-1]:
-            self._emit_chunk(part)
+        start = 0
+        while (end := s.find('\n', start)) != -1:
+            self._emit_chunk(s[start:end])
             self._emit_eol()
-        self._emit_chunk(parts[-1])
-
-    def _emit_chunk_bytes(self, b):
-        if len(b) == 0:
-            return
-        if self.at_bol:
-            self._emit_tag()
-        sys.stdout.flush()
-        sys.stdout.buffer.write(b)
+            start = end + 1
+        self._emit_chunk(s[start:])
 
     def write_bytes(self, b):
-        parts = b.split(b'\n')
-        for part in parts[:-1]:
-            self._emit_chunk_bytes(part)
-            self._emit_eol()
-        self._emit_chunk_bytes(parts[-1])
+        # Assemble the output for the whole chunk, including line prefixes,
+        # and hand it to the binary buffer in one write.  The text layer is
+        # flushed first, since earlier prefixes may still be buffered there.
+        out = bytearray()
+        start = 0
+        while True:
+            end = b.find(b'\n', start)
+            if end == -1:
+                end = len(b)
+            if end > start:
+                if self.at_bol:
+                    out += self._tag().encode()
+                    self.at_bol = False
+                out += b[start:end]
+            if end == len(b):
+                break
+            if self.at_bol:
+                out += self._tag().encode()
+            out += b'\n'
+            self.at_bol = True
+            start = end + 1
+        if len(out) > 0:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(out)
 
     def print(self, s):
         self.write(s)
@@ -96,3 +120,64 @@ class ChunkPrinter:
 
     def flush(self):
         sys.stdout.flush()
+
+
+class IterReader(io.RawIOBase):
+    """
+    Read-only file object over an iterable of `bytes` chunks, such as a
+    streamed HTTP response body.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._buf) == 0:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buf = memoryview(chunk)
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+class _TarSink:
+    """
+    Write-only file object that collects the blocks `tarfile` produces in
+    stream mode, so `iter_tar` can hand them out as they're generated.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def take(self):
+        chunks = self.chunks
+        self.chunks = []
+        return chunks
+
+
+def iter_tar(files):
+    """
+    Generate a tar archive containing `files`, an iterable of `(path, body)`
+    pairs, and yield it in chunks.  Only one file body needs to be in memory at
+    a time, so the caller can stream the archive somewhere without building
+    the whole thing first.
+    """
+    sink = _TarSink()
+    with tarfile.open(fileobj=sink, mode='w|') as t:
+        for path, body in files:
+            info = tarfile.TarInfo(path)
+            info.size = len(body)
+            t.addfile(info, io.BytesIO(body))
+            yield from sink.take()
+    yield from sink.take()
@@ -1,8 +1,12 @@
+import concurrent.futures
 from contextlib import contextmanager
+import errno
 import glob
 import os
+import re
 from pathspec.pathspec import PathSpec
 import shutil
+import stat
 from typing import Union, Sequence
 
 from .mvir import FileNode, TreeNode
@@ -21,38 +25,202 @@ class WorkDir:
     The usual workflow with this type is to populate the directory with one or
     more inputs from MVIR using `checkout` methods, run some command on the
     inputs, and store the outputs back into MVIR using the `commit` methods.
+
+    If `follow_symlinks` is false, the contents of the directory are treated
+    as untrusted, as when it's shared with a sandbox: checkouts and commits
+    never follow a symlink out of the directory, and committing a symlink or
+    other non-regular file raises `ValueError`.
     """
-    def __init__(self, mvir, path):
+    def __init__(self, mvir, path, follow_symlinks=True):
         self.mvir = mvir
         self.path = path
+        self.follow_symlinks = follow_symlinks
+
+    # Number of threads used by `checkout` for trees with many files.
+    _CHECKOUT_THREADS = 8
 
     def checkout(self, n_tree):
         assert isinstance(n_tree, TreeNode)
-        for rel_path, n_file_id in n_tree.files.items():
+        self.checkout_many(n_tree.files)
+
+    def checkout_many(self, files, overwrite=False):
+        """
+        Check out each file in `files`, a dict mapping relative paths to
+        `FileNode` IDs.  If `overwrite` is set, existing files are replaced;
+        otherwise it's an error for any of the paths to exist already.
+        """
+        # Group paths by content, so that each `FileNode` is loaded once even
+        # if the tree contains several copies of it.  Each path still gets
+        # its own file rather than a hard link, since commands run in the work
+        # dir may modify files in place.
+        paths_by_id = {}
+        for rel_path, n_file_id in files.items():
+            paths_by_id.setdefault(n_file_id, []).append(rel_path)
+        items = list(paths_by_id.items())
+
+        def checkout_one(item):
+            n_file_id, rel_paths = item
             n_file = self.mvir.node(n_file_id)
-            self.checkout_file(rel_path, n_file)
+            for rel_path in rel_paths:
+                self.checkout_file(rel_path, n_file, overwrite)
+
+        if len(items) < 2 * self._CHECKOUT_THREADS:
+            for item in items:
+                checkout_one(item)
+            return
+
+        # Files are independent, so load and write them on a thread pool to
+        # overlap their I/O.  Parent directories are created up front so the
+        # workers don't race to create them.
+        for rel_dir in {os.path.dirname(rel_path) for rel_path in files}:
+            if self.follow_symlinks:
+                os.makedirs(os.path.join(self.path, rel_dir), exist_ok=True)
+            else:
+                os.close(self._open_dir(rel_dir, create=True))
+        with concurrent.futures.ThreadPoolExecutor(self._CHECKOUT_THREADS) as executor:
+            for _ in executor.map(checkout_one, items):
+                pass
 
-    def checkout_file(self, rel_path, n_file):
+    def checkout_file(self, rel_path, n_file, overwrite=False):
         assert not os.path.isabs(rel_path)
         assert isinstance(n_file, FileNode)
-        path = os.path.join(self.path, rel_path)
-        assert not os.path.exists(path), \
-            'path %r already exists in work dir %r' % (rel_path, self.path)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(n_file.body())
+        fd = self._create_file(rel_path, overwrite)
+        try:
+            # Large bodies that haven't been loaded are copied directly from
+            # the node file.
+            n_file.write_body(fd)
+        finally:
+            os.close(fd)
+
+    def checkout_file_untracked(self, rel_path, body, overwrite=False):
+        """
+        Write `body` to `rel_path` in the work dir, without storing it in
+        MVIR.
+        """
+        assert not os.path.isabs(rel_path)
+        assert isinstance(body, bytes)
+        with open(self._create_file(rel_path, overwrite), 'wb') as f:
+            f.write(body)
+
+    def _create_file(self, rel_path, overwrite):
+        """
+        Create the file `rel_path` and its parent directories, and return a
+        file descriptor open for writing to it.
+        """
+        if self.follow_symlinks:
+            path = os.path.join(self.path, rel_path)
+            assert overwrite or not os.path.exists(path), \
+                'path %r already exists in work dir %r' % (rel_path, self.path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+
+        dir_fd = self._open_dir(os.path.dirname(rel_path), create=True)
+        try:
+            name = os.path.basename(rel_path)
+            if overwrite:
+                # Replace whatever is there, rather than writing through it if
+                # it's a symlink.
+                try:
+                    os.unlink(name, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    pass
+            return os.open(name,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o666,
+                dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _open_dir(self, rel_dir, create=False):
+        """
+        Open the directory `rel_dir` inside the work dir without following any
+        symlinks, and return its file descriptor.  If `create` is set, missing
+        directories are created.  Raises `ValueError` if any component of
+        `rel_dir` is a symlink or not a directory.
+        """
+        fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for part in os.path.normpath(rel_dir).split(os.sep):
+                if part in ('', '.'):
+                    continue
+                assert part != '..', 'path %r escapes the work dir' % (rel_dir,)
+                if create:
+                    try:
+                        os.mkdir(part, dir_fd=fd)
+                    except FileExistsError:
+                        pass
+                try:
+                    next_fd = os.open(part,
+                        os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+                except OSError as e:
+                    if e.errno in (errno.ELOOP, errno.ENOTDIR):
+                        raise ValueError(f"expected a directory, but got a symlink "
+                            f"or other file for {rel_dir}") from e
+                    raise
+                os.close(fd)
+                fd = next_fd
+        except:
+            os.close(fd)
+            raise
+        return fd
 
     def commit(self, globs: Union[str, Sequence[str]]):
         if isinstance(globs, str):
             globs = (globs,)
-        all_rel_paths = set(os.path.normpath(rel_path)
-            for g in globs
-            for rel_path in glob.glob(g, root_dir=self.path, recursive=True))
-        dct = {}
-        for rel_path in all_rel_paths:
-            assert rel_path not in dct
-            dct[rel_path] = self.commit_file(rel_path).node_id()
-        return TreeNode.new(self.mvir, files=dct)
+        # Walk the work dir once and match every file against all the
+        # patterns, instead of running a separate `glob` traversal for each
+        # pattern.  Only the directories that some pattern could match under
+        # are walked.
+        globs = [os.path.normpath(g) for g in globs]
+        patterns = [re.compile(glob.translate(g, recursive=True)) for g in globs]
+        all_rel_paths = set()
+        for root, depth in set(_glob_walk_roots(g) for g in globs):
+            for rel_path in self._walk_files(root, depth):
+                if any(p.match(rel_path) for p in patterns):
+                    all_rel_paths.add(rel_path)
+        return TreeNode.new(self.mvir, files=self._commit_files(all_rel_paths))
+
+    # Number of threads used by `commit` and `commit_dir` for many files.
+    _COMMIT_THREADS = 8
+
+    def _commit_files(self, rel_paths):
+        '''Commit each of `rel_paths` with `commit_file`, and return a dict
+        mapping each path to its `NodeId`.'''
+        if len(rel_paths) < 2 * self._COMMIT_THREADS:
+            return {rel_path: self.commit_file(rel_path).node_id()
+                for rel_path in rel_paths}
+        # Reading and hashing files releases the GIL, so a thread pool
+        # overlaps the I/O and hashing of different files.
+        def commit_one(rel_path):
+            return rel_path, self.commit_file(rel_path).node_id()
+        with concurrent.futures.ThreadPoolExecutor(self._COMMIT_THREADS) as executor:
+            return dict(executor.map(commit_one, rel_paths))
+
+    def _walk_files(self, rel_dir, depth=None):
+        """
+        Yield the relative paths of all files under `rel_dir`, which is
+        relative to the work dir, descending at most `depth` levels (or all the
+        way, if `depth` is `None`).  Like `glob`, this follows symlinks to
+        directories, unless `follow_symlinks` is false.
+        """
+        stack = [(rel_dir, depth)]
+        while stack:
+            rel_dir, depth = stack.pop()
+            try:
+                it = os.scandir(os.path.join(self.path, rel_dir))
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                    # Symlinks are passed to `commit_file`, which rejects
+                    # them, if the directory is untrusted.
+                    if entry.is_dir(follow_symlinks=self.follow_symlinks):
+                        if depth is None:
+                            stack.append((rel_path, None))
+                        elif depth > 0:
+                            stack.append((rel_path, depth - 1))
+                    else:
+                        yield rel_path
 
     def commit_dir(self, rel_path, ignore_spec: PathSpec | None = None):
         """
@@ -65,29 +233,71 @@ class WorkDir:
 
         assert not os.path.isabs(rel_path)
         path = os.path.join(self.path, rel_path)
-        files = {}
+        file_paths = []
         if os.path.exists(path):
             for (dir_path, dir_names, file_names) in os.walk(path):
                 dir_path_rel = os.path.relpath(dir_path, self.path)
+                if not self.follow_symlinks:
+                    # `os.walk` lists symlinks to directories in `dir_names`,
+                    # but doesn't descend into them.  Commit them like files,
+                    # so `commit_file` rejects them.
+                    file_names = file_names + [name for name in dir_names
+                        if os.path.islink(os.path.join(dir_path, name))]
                 for file_name in file_names:
                     file_path = os.path.join(dir_path_rel, file_name)
                     if ignore_spec is not None and ignore_spec.match_file(file_path):
                         continue
 
-                    assert file_path not in files
-                    files[file_path] = self.commit_file(file_path).node_id()
-        return TreeNode.new(self.mvir, files=files)
+                    file_paths.append(file_path)
+        assert len(set(file_paths)) == len(file_paths)
+        return TreeNode.new(self.mvir, files=self._commit_files(file_paths))
 
     def commit_file(self, rel_path):
         assert not os.path.isabs(rel_path)
-        path = os.path.join(self.path, rel_path)
-        assert os.path.exists(path)
-        with open(path, 'rb') as f:
-            return FileNode.new(self.mvir, f.read())
+        if self.follow_symlinks:
+            path = os.path.join(self.path, rel_path)
+            assert os.path.exists(path)
+            return FileNode.new_from_path(self.mvir, path)
+
+        dir_fd = self._open_dir(os.path.dirname(rel_path))
+        def opener(name, flags):
+            return os.open(name, flags | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=dir_fd)
+        try:
+            try:
+                f = open(os.path.basename(rel_path), 'rb', opener=opener)
+            except OSError as e:
+                if e.errno == errno.ELOOP:
+                    raise ValueError(f"expected a regular file, but got a symlink "
+                        f"for file {rel_path}") from e
+                raise
+        finally:
+            os.close(dir_fd)
+        with f:
+            if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                raise ValueError(f"expected a regular file for file {rel_path}")
+            return FileNode.new_from_file(self.mvir, f)
 
     def join(self, *args, **kwargs):
         return os.path.join(self.path, *args, **kwargs)
 
+def _glob_walk_roots(g):
+    """
+    Return `(root, depth)` describing which part of the work dir must be
+    walked to find all matches for the pattern `g`: `root` is its longest
+    directory prefix without wildcards (`''` for the top level), and `depth`
+    is how many directory levels below `root` a match can be, or `None` if
+    the pattern contains `**`.
+    """
+    parts = g.split(os.sep)
+    prefix = []
+    for part in parts[:-1]:
+        if glob.has_magic(part):
+            break
+        prefix.append(part)
+    rest = parts[len(prefix):]
+    depth = None if '**' in rest else len(rest) - 1
+    return (os.path.join(*prefix) if prefix else ''), depth
+
 KEEP_WORK_DIR = False
 
 @contextmanager
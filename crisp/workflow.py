@@ -1,4 +1,4 @@
-import cbor
+import cbor2 as cbor
 import dataclasses
 from dataclasses import dataclass
 from datetime import datetime
@@ -526,8 +526,9 @@ class Workflow:
         with run_sandbox(cfg, mvir) as sb:
             output_path = cfg.relative_path(os.path.join(cfg.transpile.output_dir, subdir))
 
-            sb.checkout(n_c_code)
-            sb.checkout_file(COMPILE_COMMANDS_PATH, n_cc)
+            # Check out the C code and `compile_commands.json` together, so
+            # the sandbox receives them in one archive.
+            sb.checkout_many(n_c_code.files | {COMPILE_COMMANDS_PATH: n_cc.node_id()})
 
             # Create each directory mentioned in compile_commands.json, since
             # c2rust may assume that they already exist.
@@ -0,0 +1,215 @@
+import tempfile
+import unittest
+
+from crisp.llm_format.abc import _glob_matcher
+from crisp.llm_format.markdown import MarkdownFileFormat
+from crisp.llm_format.xml import XmlFileFormat
+from crisp.mvir import MVIR, FileNode, TreeNode
+
+
+MARKDOWN_OUTPUT = '''Here is the updated code.
+
+src/lib.rs
+```Rust
+fn main() {
+    println!("hi");
+}
+```
+
+Some commentary, then a second file:
+src/util.c
+```c
+int x;
+```
+
+not a path
+```Rust
+fn ignored() {}
+```
+'''
+
+XML_OUTPUT = '''Here is the updated code.
+<file name="src/lib.rs">
+fn main() {}
+</file>
+<file name="../escape.rs">
+fn ignored() {}
+</file>
+<file name="src/util.rs">
+fn util() {}
+</file
+'''
+
+
+class GlobMatcherTest(unittest.TestCase):
+    def test_matches_like_pure_path(self):
+        match = _glob_matcher('rust/src/*.rs')
+        self.assertTrue(match('rust/src/lib.rs'))
+        self.assertTrue(match('crate/rust/src/lib.rs'))
+        self.assertFalse(match('rust/src/bin/main.rs'))
+        self.assertFalse(match('src/lib.rs'))
+
+    def test_absolute_pattern(self):
+        match = _glob_matcher('/src/*.rs')
+        self.assertTrue(match('/src/lib.rs'))
+        self.assertFalse(match('src/lib.rs'))
+        self.assertFalse(match('/a/src/lib.rs'))
+
+
+def make_tree(mvir, files):
+    return TreeNode.new(mvir, files={
+        path: FileNode.new(mvir, text).node_id()
+        for path, text in files.items()
+    })
+
+
+class MvirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mvir = MVIR(self.tmp.name, '.')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+class MarkdownFileFormatTest(MvirTestCase):
+
+    def test_emit_files(self):
+        n = make_tree(self.mvir, {
+            'rust/src/lib.rs': 'fn main() {}\n',
+            'rust/src/util.c': 'int x;\n',
+            'rust/Cargo.toml': '[package]\n',
+        })
+        text, short_path_map = MarkdownFileFormat().emit_files(self.mvir, n)
+        self.assertEqual(text,
+            'src/lib.rs\n```Rust\nfn main() {}\n\n```\n\n'
+            'src/util.c\n```C\nint x;\n\n```')
+        self.assertEqual(short_path_map, {
+            'src/lib.rs': 'rust/src/lib.rs',
+            'src/util.c': 'rust/src/util.c',
+        })
+
+        data, _ = MarkdownFileFormat().emit_files(self.mvir, n, as_bytes=True)
+        self.assertEqual(data, text.encode('utf-8'))
+
+    def test_iter_emit_files(self):
+        n = make_tree(self.mvir, {
+            'src/lib.rs': 'fn main() {}\n',
+            'src/util.rs': 'fn util() {}\n',
+        })
+        fmt = MarkdownFileFormat()
+        text, expected_map = fmt.emit_files(self.mvir, n)
+        short_path_map = {}
+        chunks = list(fmt.iter_emit_files(self.mvir, n,
+            short_path_map=short_path_map))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), text)
+        self.assertEqual(short_path_map, expected_map)
+
+    def test_emit_files_single_and_empty(self):
+        fmt = MarkdownFileFormat()
+        n = make_tree(self.mvir, {'rust/src/lib.rs': 'fn main() {}\n'})
+        self.assertEqual(fmt.emit_files(self.mvir, n), (
+            'lib.rs\n```Rust\nfn main() {}\n\n```',
+            {'lib.rs': 'rust/src/lib.rs'},
+        ))
+        n = make_tree(self.mvir, {})
+        self.assertEqual(fmt.emit_files(self.mvir, n), ('', {}))
+        self.assertEqual(fmt.emit_files(self.mvir, n, as_bytes=True), (b'', {}))
+
+    def test_emit_files_cache(self):
+        fmt = MarkdownFileFormat()
+        fmt.EMIT_CACHE_LIMIT = 80
+        n = make_tree(self.mvir, {
+            'src/lib.rs': 'fn main() {}\n',
+            'src/util.rs': 'fn util() {}\n',
+        })
+        first = fmt.emit_files(self.mvir, n)
+        self.assertEqual(len(fmt._emit_cache), 2)
+        self.assertEqual(fmt.emit_files(self.mvir, n), first)
+
+        n = make_tree(self.mvir, {'src/big.rs': 'x' * 100})
+        fmt.emit_files(self.mvir, n)
+        self.assertEqual(len(fmt._emit_cache), 2)
+        n = make_tree(self.mvir, {'src/lib.rs': 'fn lib() {}\n' * 3})
+        fmt.emit_files(self.mvir, n)
+        self.assertLessEqual(fmt._emit_cache_size, fmt.EMIT_CACHE_LIMIT)
+        self.assertEqual(len(fmt._emit_cache), 1)
+
+    def test_emit_files_glob_filter(self):
+        n = make_tree(self.mvir, {
+            'rust/src/lib.rs': 'fn main() {}\n',
+            'rust/src/bin/main.rs': 'fn main() {}\n',
+        })
+        _, short_path_map = MarkdownFileFormat().emit_files(
+            self.mvir, n, glob_filter='rust/src/*.rs')
+        self.assertEqual(short_path_map, {'lib.rs': 'rust/src/lib.rs'})
+
+    def test_extract_files(self):
+        files = MarkdownFileFormat().extract_files(MARKDOWN_OUTPUT)
+        self.assertEqual(files, [
+            ('src/lib.rs', 'fn main() {\n    println!("hi");\n}\n'),
+            ('src/util.c', 'int x;\n'),
+        ])
+
+    def test_extract_files_crlf(self):
+        s = MARKDOWN_OUTPUT.replace('\n', '\r\n')
+        self.assertEqual(MarkdownFileFormat().extract_files(s),
+            MarkdownFileFormat().extract_files(MARKDOWN_OUTPUT))
+
+    def test_extract_files_empty_block(self):
+        s = 'src/lib.rs\n```Rust\n```\n'
+        self.assertEqual(MarkdownFileFormat().extract_files(s), [('src/lib.rs', '\n')])
+
+    def test_extract_files_rejects_mismatched_language(self):
+        s = 'src/lib.rs\n```C\nint x;\n```\n'
+        self.assertEqual(MarkdownFileFormat().extract_files(s), [])
+
+    def test_extract_files_ignores_unterminated_block(self):
+        s = 'src/lib.rs\n```Rust\nfn main() {}\n'
+        self.assertEqual(MarkdownFileFormat().extract_files(s), [])
+
+
+class XmlFileFormatTest(MvirTestCase):
+    def test_emit_files(self):
+        n = make_tree(self.mvir, {
+            'src/lib.rs': 'fn main() {}\n',
+            'src/util.rs': 'fn util() {}\n',
+        })
+        text, short_path_map = XmlFileFormat().emit_files(self.mvir, n)
+        self.assertEqual(text,
+            '<file name="lib.rs">\nfn main() {}\n\n</file>\n\n'
+            '<file name="util.rs">\nfn util() {}\n\n</file>')
+        self.assertEqual(short_path_map, {
+            'lib.rs': 'src/lib.rs',
+            'util.rs': 'src/util.rs',
+        })
+
+        data, _ = XmlFileFormat().emit_files(self.mvir, n, as_bytes=True)
+        self.assertEqual(data, text.encode('utf-8'))
+
+    def test_extract_files(self):
+        files = XmlFileFormat().extract_files(XML_OUTPUT)
+        self.assertEqual(files, [
+            ('src/lib.rs', 'fn main() {}\n'),
+            ('src/util.rs', 'fn util() {}\n'),
+        ])
+
+    def test_extract_files_crlf(self):
+        s = XML_OUTPUT.replace('\n', '\r\n')
+        self.assertEqual(XmlFileFormat().extract_files(s),
+            XmlFileFormat().extract_files(XML_OUTPUT))
+
+    def test_extract_files_form_feed(self):
+        s = '<file name="src/a.c">\nx\x0cy\n</file>\n'
+        self.assertEqual(XmlFileFormat().extract_files(s), [('src/a.c', 'x\x0cy\n')])
+        self.assertEqual(XmlFileFormat().extract_files(s.replace('\n', '\r\n')),
+            [('src/a.c', 'x\x0cy\n')])
+
+    def test_extract_files_empty_block(self):
+        s = '<file name="src/lib.rs">\n</file>\n'
+        self.assertEqual(XmlFileFormat().extract_files(s), [('src/lib.rs', '\n')])
+
+
+if __name__ == '__main__':
+    unittest.main()
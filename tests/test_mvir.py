@@ -0,0 +1,192 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from crisp.mvir import (MVIR, FileNode, IndexEntry, NodeId, TreeNode,
+    _copy_fd_range, _write_all)
+
+
+class MvirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mvir = MVIR(self.tmp.name, '.')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def reopen(self):
+        '''Open a fresh `MVIR` on the same directory, so that nodes are read
+        back from disk instead of the in-memory cache.'''
+        return MVIR(self.tmp.name, '.')
+
+    def test_node_ids_are_stable(self):
+        # These IDs were produced by earlier versions of CRISP.  Changing them
+        # would orphan every existing node store.
+        f = FileNode.new(self.mvir, 'fn main() {}\n')
+        t = TreeNode.new(self.mvir, files={'src/main.rs': f.node_id()})
+        self.assertEqual(str(f.node_id()),
+            '7f948686ba2b8da66e70b47476edcefe97123dbedcdb1c7a6acd72b8310690d2')
+        self.assertEqual(str(t.node_id()),
+            '4e3175a76d74f97fd86fba3c1c389d8ec5040374a8ae5e13c4cec514389785ac')
+
+    def test_round_trip(self):
+        f = FileNode.new(self.mvir, 'fn main() {}\n')
+        t = TreeNode.new(self.mvir, files={'src/main.rs': f.node_id()})
+
+        mvir = self.reopen()
+        t2 = mvir.node(t.node_id())
+        self.assertIsInstance(t2, TreeNode)
+        self.assertEqual(t2.metadata(), t.metadata())
+        self.assertEqual(t2.body(), b'')
+        f2 = mvir.node(t2.files['src/main.rs'])
+        self.assertEqual(f2.body_str(), 'fn main() {}\n')
+
+    def test_body_round_trip(self):
+        small = FileNode.new(self.mvir, b'small')
+        large = FileNode.new(self.mvir, bytes(range(256)) * 5000)
+
+        mvir = self.reopen()
+        self.assertEqual(mvir.node(small.node_id()).body(), b'small')
+        self.assertEqual(mvir.node(large.node_id()).body(), bytes(range(256)) * 5000)
+
+    def test_new_many(self):
+        bodies = [(str(i), b'%d' % (i % 10) * (i * 100)) for i in range(200)]
+        ids = FileNode.new_many(self.mvir, iter(bodies))
+        self.assertEqual(list(ids), [k for k, _ in bodies])
+        mvir = self.reopen()
+        for k, body in bodies:
+            self.assertEqual(ids[k], FileNode.new(self.mvir, body).node_id())
+            self.assertEqual(mvir.node(ids[k]).body(), body)
+
+    def test_new_from_path(self):
+        for body in (b'small', bytes(range(256)) * 10000):
+            path = os.path.join(self.tmp.name, 'input')
+            with open(path, 'wb') as f:
+                f.write(body)
+            n = FileNode.new_from_path(self.mvir, path)
+            self.assertEqual(n.node_id(), FileNode.new(self.mvir, body).node_id())
+            self.assertEqual(self.reopen().node(n.node_id()).body(), body)
+            # Storing the same contents again reuses the existing node.
+            self.assertIs(FileNode.new_from_path(self.mvir, path), n)
+
+    def test_body_json(self):
+        f = FileNode.new(self.mvir, '{"a": [1, "\u00e9", null], "b": NaN}')
+        j = self.reopen().node(f.node_id()).body_json()
+        self.assertEqual(j['a'], [1, '\u00e9', None])
+        self.assertNotEqual(j['b'], j['b'])
+
+    def test_write_body(self):
+        body = bytes(range(256)) * 5000
+        n = self.reopen().node(FileNode.new(self.mvir, body).node_id())
+        with tempfile.TemporaryFile() as f:
+            n.write_body(f.fileno())
+            f.seek(0)
+            self.assertEqual(f.read(), body)
+        self.assertEqual(n.body(), body)
+
+    def test_node_id_from_str(self):
+        f = FileNode.new(self.mvir, 'x')
+        s = str(f.node_id())
+        self.assertEqual(NodeId.from_str(s), f.node_id())
+        self.assertEqual(NodeId.from_str(s.upper()), f.node_id())
+        with self.assertRaises(ValueError):
+            NodeId.from_str(s[:-2])
+        with self.assertRaises(ValueError):
+            NodeId.from_str(s[:-2] + '  ')
+        with self.assertRaises(ValueError):
+            NodeId.from_str(s[:-2] + 'zz')
+        self.assertEqual(self.mvir.node_ids_with_prefix(s[:5]), [f.node_id()])
+
+    def test_tag_reflog(self):
+        a = FileNode.new(self.mvir, 'a')
+        b = FileNode.new(self.mvir, 'b')
+        self.mvir.set_tag('current', a, 'first')
+        self.mvir.set_tag('current', b, ['second', 2])
+
+        mvir = self.reopen()
+        self.assertEqual(mvir.tag('current'), b.node_id())
+        reflog = mvir.tag_reflog('current')
+        self.assertEqual([e.node_id for e in reflog], [a.node_id(), b.node_id()])
+        self.assertEqual([e.reason for e in reflog], ['first', ['second', 2]])
+        self.assertLessEqual(reflog[0].timestamp, reflog[1].timestamp)
+
+    def test_index(self):
+        f = FileNode.new(self.mvir, 'fn main() {}\n')
+        t1 = TreeNode.new(self.mvir, files={'a.rs': f.node_id()})
+        t2 = TreeNode.new(self.mvir, files={'b.rs': f.node_id(), 'c.rs': f.node_id()})
+
+        entries = self.reopen().index(f.node_id())
+        self.assertCountEqual(entries, [
+            IndexEntry(t1.node_id(), 'tree', 'files'),
+            IndexEntry(t2.node_id(), 'tree', 'files'),
+            IndexEntry(t2.node_id(), 'tree', 'files'),
+        ])
+
+        # Nodes created after the last index update are picked up on the next
+        # query.
+        t3 = TreeNode.new(self.mvir, files={'d.rs': f.node_id()})
+        entries = self.reopen().index(f.node_id())
+        self.assertIn(IndexEntry(t3.node_id(), 'tree', 'files'), entries)
+        self.assertEqual(len(entries), 4)
+
+    def test_index_many_nodes(self):
+        f = FileNode.new(self.mvir, 'fn main() {}\n')
+        trees = [TreeNode.new(self.mvir, files={'%d.rs' % i: f.node_id()})
+            for i in range(100)]
+        entries = self.reopen().index(f.node_id())
+        self.assertCountEqual([e.node_id for e in entries],
+            [t.node_id() for t in trees])
+
+    def test_index_many_entries(self):
+        # More entries for one destination than a single `writev` call
+        # accepts.  `_JOIN_WRITE_MAX` is lowered so this doesn't need
+        # megabytes of entries.
+        f = FileNode.new(self.mvir, 'fn main() {}\n')
+        for i in range(1500):
+            TreeNode.new(self.mvir, files={'%d.rs' % i: f.node_id()})
+        with mock.patch('crisp.mvir._JOIN_WRITE_MAX', 0):
+            self.assertEqual(len(self.reopen().index(f.node_id())), 1500)
+        self.assertEqual(len(self.reopen().index(f.node_id())), 1500)
+
+
+class WriteAllTest(unittest.TestCase):
+    def test_more_chunks_than_iov_max(self):
+        # Large enough to use `writev`, with more buffers than a single
+        # `writev` call accepts.
+        chunks = [b'%04d' % i * 256 for i in range(4000)]
+        with tempfile.TemporaryFile() as f:
+            _write_all(f.fileno(), chunks)
+            f.seek(0)
+            self.assertEqual(f.read(), b''.join(chunks))
+
+
+class CopyFdRangeTest(unittest.TestCase):
+    def copy(self, data, offset, count):
+        with tempfile.TemporaryFile() as src, tempfile.TemporaryFile() as dst:
+            src.write(data)
+            src.flush()
+            _copy_fd_range(src.fileno(), offset, dst.fileno(), count)
+            dst.seek(0)
+            return dst.read()
+
+    def test_copy(self):
+        data = os.urandom(100000)
+        self.assertEqual(self.copy(data, 1000, 50000), data[1000:51000])
+
+    def test_copier_returns_zero(self):
+        # Some filesystems return 0 from `copy_file_range` instead of failing
+        # when it isn't supported.  The copy should fall back to another
+        # method rather than report an end of file.
+        data = os.urandom(100000)
+        with mock.patch('os.copy_file_range', return_value=0, create=True), \
+                mock.patch('os.sendfile', return_value=0, create=True):
+            self.assertEqual(self.copy(data, 1000, 50000), data[1000:51000])
+
+    def test_end_of_file(self):
+        with self.assertRaises(EOFError):
+            self.copy(b'abc', 0, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import io
+import sys
+import tarfile
+import unittest
+from unittest import mock
+
+from crisp.util import ChunkPrinter, IterReader, iter_tar
+
+
+class ChunkPrinterTest(unittest.TestCase):
+    def capture(self, f):
+        out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        with mock.patch.object(sys, 'stdout', out), \
+                mock.patch('time.strftime', return_value='00:00:00'):
+            f(ChunkPrinter(count_width=2))
+            out.flush()
+        return out.buffer.getvalue().decode('utf-8')
+
+    def test_write_bytes(self):
+        def f(p):
+            p.write_bytes(b'Hel')
+            p.write_bytes(b'lo,\n\nW')
+            p.increment()
+            p.write_bytes(b'orld!')
+            p.print(' done')
+            p.write_bytes(b'\n')
+            p.finish()
+        self.assertEqual(self.capture(f),
+            '[00:00:00  0] Hello,\n'
+            '[00:00:00  0] \n'
+            '[00:00:00  0] World! done\n'
+            '[00:00:00  1] \n')
+
+    def test_write_bytes_matches_write(self):
+        chunks = ['a\nb', '', '\n\n', 'c', 'd\n', 'e']
+        def by_text(p):
+            for c in chunks:
+                p.write(c)
+            p.finish()
+        def by_bytes(p):
+            for c in chunks:
+                p.write_bytes(c.encode())
+            p.finish()
+        self.assertEqual(self.capture(by_bytes), self.capture(by_text))
+
+
+class IterTarTest(unittest.TestCase):
+    def test_round_trip(self):
+        files = [
+            ('src/main.rs', b'fn main() {}\n'),
+            ('empty.txt', b''),
+            ('big.bin', bytes(range(256)) * 200),
+        ]
+        chunks = list(iter_tar(iter(files)))
+        self.assertGreater(len(chunks), 1)
+        with tarfile.open(fileobj=io.BytesIO(b''.join(chunks)), mode='r') as t:
+            self.assertEqual(
+                [(info.name, t.extractfile(info).read()) for info in t],
+                files)
+
+    def test_stream_through_iter_reader(self):
+        files = [('a/%d' % i, b'%d' % i * (i * 37)) for i in range(50)]
+        f = IterReader(iter_tar(files))
+        with tarfile.open(fileobj=f, mode='r|') as t:
+            self.assertEqual(
+                [(info.name, t.extractfile(info).read()) for info in t],
+                files)
+        f.read()
+        self.assertEqual(f.read(), b'')
+
+    def test_empty(self):
+        data = b''.join(iter_tar([]))
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r') as t:
+            self.assertEqual(t.getmembers(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
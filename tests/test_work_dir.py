@@ -0,0 +1,147 @@
+import os
+import tempfile
+import unittest
+
+from crisp.mvir import MVIR, FileNode, TreeNode
+from crisp.work_dir import WorkDir
+
+
+class WorkDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mvir = MVIR(self.tmp.name + '/mvir', '.')
+        self.work_dir = WorkDir(self.mvir, self.tmp.name + '/work')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_checkout_commit_dir_round_trip(self):
+        # Enough files that `checkout` uses its thread pool.
+        files = {
+            'src/%d/f%d.rs' % (i % 5, i): FileNode.new(self.mvir, b'x' * i).node_id()
+            for i in range(50)
+        }
+        files['src/big.bin'] = FileNode.new(self.mvir, bytes(range(256)) * 5000).node_id()
+        # Several paths with the same contents.
+        for i in range(3):
+            files['copy/%d.rs' % i] = files['src/0/f10.rs']
+        n_tree = TreeNode.new(self.mvir, files=files)
+
+        self.work_dir.checkout(n_tree)
+        self.assertEqual(
+            self.work_dir.commit_dir('src').files | self.work_dir.commit_dir('copy').files,
+            files)
+
+    def test_checkout_many(self):
+        n_tree = TreeNode.new(self.mvir, files={
+            'src/lib.c': FileNode.new(self.mvir, 'int x;\n').node_id(),
+        })
+        n_cc = FileNode.new(self.mvir, '[]')
+        self.work_dir.checkout_many(n_tree.files | {'compile_commands.json': n_cc.node_id()})
+        self.assertEqual(self.work_dir.commit('**/*').files,
+            n_tree.files | {'compile_commands.json': n_cc.node_id()})
+
+    def test_checkout_overwrite(self):
+        a = FileNode.new(self.mvir, 'a')
+        b = FileNode.new(self.mvir, 'b')
+        self.work_dir.checkout_file('x/f', a)
+        with self.assertRaises(AssertionError):
+            self.work_dir.checkout_file('x/f', b)
+        self.work_dir.checkout_many({'x/f': b.node_id()}, overwrite=True)
+        self.assertEqual(self.work_dir.commit_file('x/f').node_id(), b.node_id())
+
+    def test_commit_globs(self):
+        for rel_path in ('a.rs', 'b.c', '.hidden.rs', 'src/lib.rs', 'src/x/y.rs',
+                'src/x/y.c', 'target/debug/t.rs'):
+            n = FileNode.new(self.mvir, rel_path)
+            self.work_dir.checkout_file(rel_path, n)
+
+        def commit(globs):
+            return sorted(self.work_dir.commit(globs).files)
+
+        self.assertEqual(commit('*.rs'), ['a.rs'])
+        self.assertEqual(commit('src/**/*.rs'), ['src/lib.rs', 'src/x/y.rs'])
+        self.assertEqual(commit('**/*.rs'),
+            ['a.rs', 'src/lib.rs', 'src/x/y.rs', 'target/debug/t.rs'])
+        self.assertEqual(commit(['./src/*.rs', 'src/*/*.c']),
+            ['src/lib.rs', 'src/x/y.c'])
+        self.assertEqual(commit('missing/*.rs'), [])
+        tree = self.work_dir.commit('src/lib.rs')
+        self.assertEqual(self.mvir.node(tree.files['src/lib.rs']).body(), b'src/lib.rs')
+
+
+class UntrustedWorkDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mvir = MVIR(self.tmp.name + '/mvir', '.')
+        self.work_dir = WorkDir(self.mvir, self.tmp.name + '/work',
+            follow_symlinks=False)
+        os.mkdir(self.work_dir.path)
+        # A file outside the work dir that symlinks inside it might target.
+        self.outside = self.tmp.name + '/outside'
+        os.mkdir(self.outside)
+        self.secret = os.path.join(self.outside, 'secret')
+        with open(self.secret, 'wb') as f:
+            f.write(b'SECRET')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_checkout_commit_dir_round_trip(self):
+        # Enough files that `checkout` uses its thread pool.
+        files = {
+            'src/%d/f%d.rs' % (i % 5, i): FileNode.new(self.mvir, b'x' * i).node_id()
+            for i in range(50)
+        }
+        files['src/big.bin'] = FileNode.new(self.mvir, bytes(range(256)) * 5000).node_id()
+        n_tree = TreeNode.new(self.mvir, files=files)
+        self.work_dir.checkout(n_tree)
+        self.assertEqual(self.work_dir.commit_dir('src').files, files)
+        self.assertEqual(self.work_dir.commit('src/**/*').files, files)
+
+    def test_commit_symlink(self):
+        os.makedirs(self.work_dir.join('src'))
+        os.symlink(self.secret, self.work_dir.join('src/x.rs'))
+        with self.assertRaises(ValueError):
+            self.work_dir.commit_file('src/x.rs')
+        with self.assertRaises(ValueError):
+            self.work_dir.commit_dir('src')
+        with self.assertRaises(ValueError):
+            self.work_dir.commit('src/*.rs')
+
+    def test_commit_symlinked_dir(self):
+        os.symlink(self.outside, self.work_dir.join('src'))
+        with self.assertRaises(ValueError):
+            self.work_dir.commit_file('src/secret')
+        with self.assertRaises(ValueError):
+            self.work_dir.commit('src/*')
+        os.makedirs(self.work_dir.join('a'))
+        os.symlink(self.outside, self.work_dir.join('a/b'))
+        with self.assertRaises(ValueError):
+            self.work_dir.commit_dir('a')
+
+    def test_checkout_replaces_symlink(self):
+        os.symlink(self.secret, self.work_dir.join('x.rs'))
+        n = FileNode.new(self.mvir, 'fn main() {}\n')
+        self.work_dir.checkout_file('x.rs', n, overwrite=True)
+        self.assertFalse(os.path.islink(self.work_dir.join('x.rs')))
+        self.assertEqual(self.work_dir.commit_file('x.rs').node_id(), n.node_id())
+        self.work_dir.checkout_file_untracked('x.rs', b'y', overwrite=True)
+        self.assertEqual(self.work_dir.commit_file('x.rs').body(), b'y')
+        with open(self.secret, 'rb') as f:
+            self.assertEqual(f.read(), b'SECRET')
+
+    def test_checkout_symlinked_dir(self):
+        os.symlink(self.outside, self.work_dir.join('src'))
+        n = FileNode.new(self.mvir, 'fn main() {}\n')
+        with self.assertRaises(ValueError):
+            self.work_dir.checkout_file('src/secret', n, overwrite=True)
+        with self.assertRaises(ValueError):
+            self.work_dir.checkout_file('src/new.rs', n)
+        self.assertEqual(os.listdir(self.outside), ['secret'])
+        with open(self.secret, 'rb') as f:
+            self.assertEqual(f.read(), b'SECRET')
+
+
+if __name__ == '__main__':
+    unittest.main()